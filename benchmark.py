@@ -0,0 +1,610 @@
+import os
+import queue
+import random
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tkinter
+import tracemalloc
+
+import browser
+import server
+
+# The per-character HTMLParser scan loop from before the scanner rewrite,
+# kept here as the baseline to compare against
+class CharHTMLParser(browser.HTMLParser):
+    def scan(self, final):
+        body = self.buffer
+        end = len(body) if final else len(body) - 3
+        i = 0
+        while i < end:
+            c = body[i]
+            if self.tag and (c == "\"" or c == "'"):
+                if self.open_quote == c:
+                    self.open_quote = None
+                elif not self.open_quote:
+                    self.open_quote = c
+            if not self.comment and body[i:i+4] == "<!--":
+                if self.text: self.add_text(self.text)
+                self.text = ""
+                self.comment = True
+                i += 4
+                continue
+            elif self.comment and body[i:i+3] == "-->":
+                self.comment = False
+                i += 3
+                continue
+            elif self.comment:
+                i += 1
+                continue
+            elif c == "<" and not self.open_quote:
+                self.tag = True
+                if self.text: self.add_text(self.text)
+                self.text = ""
+            elif c == ">" and not self.open_quote:
+                self.tag = False
+                self.add_tag(self.text)
+                self.text = ""
+            else:
+                self.text += c
+            i += 1
+        self.buffer = body[i:]
+
+WORDS = ["lorem", "ipsum", "dolor", "sit", "amet", "browser", "engineering",
+         "layout", "paint", "style", "cascade", "selector", "the", "a", "of"]
+
+def generate_page(paragraphs, seed=0):
+    rng = random.Random(seed)
+    out = ["<!doctype html><html><head><title>Bench</title>",
+           "<link rel=stylesheet href=/comment.css></head><body>"]
+    for i in range(paragraphs):
+        out.append("<div class=\"section s{}\" id=d{}>".format(i % 7, i))
+        out.append("<!-- paragraph {} -->".format(i))
+        out.append("<h2>Heading {}</h2>".format(i))
+        out.append("<p>")
+        for _ in range(rng.randint(20, 80)):
+            word = rng.choice(WORDS)
+            r = rng.random()
+            if r < 0.05:
+                out.append("<a href='/page?id={}'>{}</a> ".format(i, word))
+            elif r < 0.1:
+                out.append("<b>{}</b> ".format(word))
+            else:
+                out.append(word + " ")
+        out.append("</p></div>\n")
+    out.append("</body></html>")
+    return "".join(out)
+
+def tree_shape(node, out):
+    if isinstance(node, browser.Text):
+        out.append(node.text)
+    else:
+        out.append((node.tag, sorted(node.attributes.items())))
+    for child in node.children:
+        tree_shape(child, out)
+    return out
+
+def time_parse(parser_class, pages, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for page in pages:
+            parser_class(page).parse()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def bench_html_parser(repeat=3):
+    pages = [generate_page(n, seed=n) for n in [50, 200, 1000, 3000]]
+    for page in pages:
+        assert tree_shape(CharHTMLParser(page).parse(), []) == \
+            tree_shape(browser.HTMLParser(page).parse(), [])
+    mb = sum(len(page.encode("utf8")) for page in pages) / 1e6
+    old = time_parse(CharHTMLParser, pages, repeat)
+    new = time_parse(browser.HTMLParser, pages, repeat)
+    print("html parser: {:.2f} MB corpus".format(mb))
+    print("  per-character: {:.2f} MB/s".format(mb / old))
+    print("  scanner:       {:.2f} MB/s ({:.1f}x)".format(mb / new, old / new))
+
+# Plain __dict__ nodes like the DOM used before __slots__, for comparison
+class DictElement:
+    def __init__(self, tag, attributes, parent):
+        self.tag = tag
+        self.children = []
+        self.parent = parent
+        self.attributes = attributes
+
+class DictText:
+    def __init__(self, text, parent):
+        self.text = text
+        self.children = []
+        self.parent = parent
+
+def copy_to_dict_nodes(node, parent):
+    # each node gets its own strings, attribute dict and style dict, as
+    # the old parser and style() produced
+    if isinstance(node, browser.Text):
+        out = DictText((node.text + " ")[:-1], parent)
+    else:
+        out = DictElement((node.tag + " ")[:-1], dict(node.attributes), parent)
+    out.style = dict(node.style)
+    for child in node.children:
+        out.children.append(copy_to_dict_nodes(child, out))
+    return out
+
+def measure_bytes(fn):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = fn()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, after - before
+
+def bench_dom_memory():
+    with open("browser.css") as f:
+        rules = browser.RuleIndex(browser.CSSParser(f.read()).parse())
+    page = generate_page(3000)
+
+    def build():
+        tree = browser.HTMLParser(page).parse()
+        browser.style(tree, rules)
+        return tree
+    tree, compact = measure_bytes(build)
+    nodes = len(browser.tree_to_list(tree, []))
+    _, plain = measure_bytes(lambda: copy_to_dict_nodes(tree, None))
+    print("dom memory: {} nodes from a {:.2f} MB page".format(
+        nodes, len(page) / 1e6))
+    print("  __dict__ nodes: {:.0f} bytes/node".format(plain / nodes))
+    print("  __slots__ nodes: {:.0f} bytes/node ({:.1f}x)".format(
+        compact / nodes, plain / compact))
+
+def load_tab(page):
+    fd, path = tempfile.mkstemp(suffix=".html")
+    with os.fdopen(fd, "w") as f:
+        f.write(page)
+    tab = browser.Tab(None)
+    tab.load("file://" + path)
+    os.remove(path)
+    return tab
+
+def time_keystrokes(tab, keys, full):
+    times = []
+    for _ in range(keys):
+        if full:
+            tab.document = None
+        start = time.perf_counter()
+        tab.keypress("x")
+        tab.render()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times) * 1000
+
+def bench_keystroke(paragraphs=1000, keys=30):
+    browser.set_font_backend(browser.FixedFontBackend())
+    page = generate_page(paragraphs).replace("<body>",
+        "<body><form action=/add><p><input name=guest></p></form>", 1)
+    tab = load_tab(page)
+    tab.focus = [node for node in browser.tree_to_list(tab.nodes, [])
+                 if isinstance(node, browser.Element)
+                 and node.tag == "input"][0]
+    tab.focus.set_attribute("value", "")
+    full = time_keystrokes(tab, keys, True)
+    incremental = time_keystrokes(tab, keys, False)
+    print("keystroke latency: {} display commands".format(len(tab.display_list)))
+    print("  full render:        {:.2f} ms".format(full))
+    print("  incremental render: {:.2f} ms ({:.1f}x)".format(
+        incremental, full / incremental))
+
+def bench_font_cache(paragraphs=1000):
+    root = tkinter.Tk()
+    root.withdraw()
+    browser.set_font_backend(browser.TkFontBackend())
+    tab = load_tab(generate_page(paragraphs))
+    browser.FONT_METRICS.reset_stats()
+    tab.document = None
+    start = time.perf_counter()
+    tab.render()
+    elapsed = time.perf_counter() - start
+    stats = browser.FONT_METRICS
+    print("font metrics cache: full render in {:.0f} ms".format(elapsed * 1000))
+    print("  Tk calls made:    {}".format(stats.misses))
+    print("  Tk calls avoided: {} ({:.1%})".format(
+        stats.hits, stats.hits / (stats.hits + stats.misses)))
+    root.destroy()
+
+# Stands in for a Tk canvas, counting the items a draw creates
+class CountingCanvas:
+    def __init__(self):
+        self.created = 0
+        self.next_item = 0
+
+    def create(self, *args, **kwargs):
+        self.created += 1
+        self.next_item += 1
+        return self.next_item
+
+    create_text = create_rectangle = create_line = create
+
+    def delete(self, tag):
+        pass
+
+    def move(self, tag, dx, dy):
+        pass
+
+    def tag_lower(self, item, below):
+        pass
+
+    def tag_raise(self, tag):
+        pass
+
+def linear_cull(tab):
+    return [cmd for cmd in tab.display_list
+            if not cmd.top > tab.scroll + browser.HEIGHT - browser.CHROME_PX
+            and not cmd.bottom < tab.scroll]
+
+def bench_scroll(paragraphs=(100, 1000, 3000), frames=50):
+    browser.set_font_backend(browser.FixedFontBackend())
+    print("scroll frames: average time to cull/draw one viewport")
+    for n in paragraphs:
+        tab = load_tab(generate_page(n))
+        canvas = CountingCanvas()
+        tab.draw(canvas)
+        tab.timings = browser.FrameTimings(keep=frames)
+        max_y = tab.document.height - (browser.HEIGHT - browser.CHROME_PX)
+        linear = 0
+        for i in range(frames):
+            tab.scroll = max_y * i / (frames - 1)
+            assert linear_cull(tab) == tab.display_index.query(
+                tab.scroll, tab.scroll + browser.HEIGHT - browser.CHROME_PX)
+            start = time.perf_counter()
+            linear_cull(tab)
+            linear += time.perf_counter() - start
+            tab.draw(canvas)
+        _, indexed, _ = tab.timings.summary()["draw"]
+
+        # step-scroll from the top, counting canvas items created per frame
+        tab.scroll = 0
+        tab.draw(canvas)
+        canvas.created = 0
+        for i in range(frames):
+            tab.scrolldown()
+            tab.draw(canvas)
+        print("  {:6} commands: linear cull {:.3f} ms, indexed draw {:.3f} ms, "
+              "{:.1f} items created per scroll step".format(
+            len(tab.display_list), 1000 * linear / frames, indexed,
+            canvas.created / frames))
+
+def raster_viewport(tab):
+    # every visible command drawn straight into a new frame
+    surface = browser.RASTER_BACKEND.create_surface(
+        browser.WIDTH, browser.HEIGHT - browser.CHROME_PX)
+    for cmd in tab.display_index.query(
+            tab.scroll, tab.scroll + browser.HEIGHT - browser.CHROME_PX):
+        cmd.raster(surface, tab.scroll)
+    return surface
+
+def bench_composite(paragraphs=300, frames=30):
+    browser.set_font_backend(browser.FixedFontBackend())
+    tab = load_tab(generate_page(paragraphs))
+    tab.display_index = browser.DisplayListIndex(tab.display_list)
+    compositor = browser.Compositor()
+    # step down the page and back up: each layer is rasterized once, as
+    # it first comes into view
+    scrolls = [i * browser.SCROLL_STEP for i in range(frames)]
+    scrolls += scrolls[::-1]
+    rastered = composited = 0
+    for y in scrolls:
+        tab.scroll = y
+        start = time.perf_counter()
+        frame = compositor.frame(tab.display_list, y)
+        composited += time.perf_counter() - start
+        start = time.perf_counter()
+        assert raster_viewport(tab).to_ppm() == frame.to_ppm()
+        rastered += time.perf_counter() - start
+    print("raster scroll frames with {}: {} frames".format(
+        compositor.backend, len(scrolls)))
+    print("  raster every command:  {:.2f} ms".format(
+        1000 * rastered / len(scrolls)))
+    print("  composite layers:      {:.2f} ms ({:.1f}x, {} layers rasterized)".format(
+        1000 * composited / len(scrolls), rastered / composited,
+        compositor.rasterized))
+
+def append_paragraphs(tab, count, render_each):
+    divs = [node for node in browser.tree_to_list(tab.nodes, [])
+            if isinstance(node, browser.Element) and node.tag == "div"]
+    tab.timings = browser.FrameTimings()
+    renders = 0
+    start = time.perf_counter()
+    for i in range(count):
+        child = tab.js.create_element("p")
+        tab.js.append_child(tab.js.get_handle(divs[i % len(divs)]), child)
+        if render_each:
+            tab.render()
+            renders += 1
+    if tab.needs_render:
+        tab.render()
+        renders += 1
+    elapsed = time.perf_counter() - start
+    tab.timings.end_frame()
+    return elapsed * 1000, renders
+
+def bench_frame(paragraphs=300, mutations=50):
+    browser.set_font_backend(browser.FixedFontBackend())
+    page = generate_page(paragraphs)
+    each, each_renders = append_paragraphs(load_tab(page), mutations, True)
+    tab = load_tab(page)
+    once, renders = append_paragraphs(tab, mutations, False)
+    print("frame scheduling: {} appendChild calls on a {}-paragraph page".format(
+        mutations, paragraphs))
+    print("  render per mutation: {:7.2f} ms ({} renders)".format(
+        each, each_renders))
+    print("  one render a frame:  {:7.2f} ms ({} render, {:.1f}x)".format(
+        once, renders, each / once))
+    print("  frame breakdown: " + ", ".join(
+        "{} {:.2f} ms".format(phase, ms)
+        for phase, ms in tab.timings.breakdown().items()))
+
+# BlockLayout.text from before batched line breaking, kept here as the
+# baseline: each word is measured and checked against the line on its own,
+# and TextLayout.layout measures it again
+def word_loop_text(self, node):
+    font = self.get_font(node)
+    for word in node.text.split():
+        w = font.measure(word)
+        if self.cursor_x + w > self.width:
+            self.new_line()
+        line = self.children[-1]
+        text = browser.TextLayout(node, word, line, self.previous_word)
+        line.children.append(text)
+        self.previous_word = text
+        self.cursor_x += w + font.measure(" ")
+
+def long_paragraph_page(paragraphs, words, seed=0):
+    rng = random.Random(seed)
+    return "<!doctype html><html><body>" + "".join(
+        "<p>" + " ".join(rng.choice(WORDS) for _ in range(words)) + "</p>"
+        for _ in range(paragraphs)) + "</body></html>"
+
+def layout_commands(tree):
+    document = browser.DocumentLayout(tree)
+    document.layout()
+    display_list = []
+    document.paint(display_list)
+    return [(cmd.left, cmd.top, getattr(cmd, "text", None))
+            for cmd in display_list]
+
+def time_layout(tree, text, min_words, repeat):
+    browser.BlockLayout.text = text
+    browser.MIN_VECTOR_WORDS = min_words
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        browser.DocumentLayout(tree).layout()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000
+
+def bench_line_breaking(repeat=5):
+    browser.set_font_backend(browser.FixedFontBackend())
+    with open("browser.css") as f:
+        rules = browser.RuleIndex(browser.CSSParser(f.read()).parse())
+    batched, min_words = browser.BlockLayout.text, browser.MIN_VECTOR_WORDS
+    ways = [("word loop", word_loop_text, min_words),
+            ("batched", batched, float("inf"))]
+    if browser.numpy is not None:
+        ways.append(("batched, numpy", batched, min_words))
+    print("line breaking: full layout of each page")
+    for name, page in [
+        ("1000 mixed paragraphs", generate_page(1000)),
+        ("100 paragraphs of 2000 words", long_paragraph_page(100, 2000)),
+    ]:
+        tree = browser.HTMLParser(page).parse()
+        browser.style(tree, rules)
+        expected = None
+        results = []
+        for way, text, min_vector_words in ways:
+            browser.BlockLayout.text = text
+            browser.MIN_VECTOR_WORDS = min_vector_words
+            commands = layout_commands(tree)
+            assert expected is None or commands == expected
+            expected = commands
+            results.append(time_layout(tree, text, min_vector_words, repeat))
+        browser.BlockLayout.text = batched
+        browser.MIN_VECTOR_WORDS = min_words
+        print("  {}: {}".format(name, ", ".join(
+            "{} {:.0f} ms ({:.2f}x)".format(way, ms, results[0] / ms)
+            for (way, _, _), ms in zip(ways, results))))
+
+def listen():
+    listener = socket.socket()
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(("localhost", 0))
+    listener.listen()
+    return listener, listener.getsockname()[1]
+
+def serve(listener, handle):
+    def accept():
+        while True:
+            conx, _ = listener.accept()
+            threading.Thread(target=handle, args=(conx,), daemon=True).start()
+    threading.Thread(target=accept, daemon=True).start()
+
+def pump(src, dst, delay):
+    # forward src to dst, delivering each piece delay seconds after it
+    # was received
+    pieces = queue.Queue()
+    def send():
+        while True:
+            due, data = pieces.get()
+            time.sleep(max(0, due - time.perf_counter()))
+            if not data: break
+            dst.sendall(data)
+        dst.shutdown(socket.SHUT_WR)
+    threading.Thread(target=send, daemon=True).start()
+    while True:
+        data = src.recv(65536)
+        pieces.put((time.perf_counter() + delay, data))
+        if not data: break
+
+# Runs a server behind a proxy that adds rtt seconds to every round
+# trip, and returns the proxy's port
+def start_behind_proxy(handle_connection, rtt):
+    listener, port = listen()
+    serve(listener, handle_connection)
+    proxy, proxy_port = listen()
+    def handle(client):
+        upstream = socket.create_connection(("localhost", port))
+        threading.Thread(target=pump, args=(upstream, client, rtt / 2),
+                         daemon=True).start()
+        pump(client, upstream, rtt / 2)
+    serve(proxy, handle)
+    return proxy_port
+
+def start_guest_book(rtt):
+    return start_behind_proxy(server.handle_connection, rtt)
+
+def time_fetches(fetch, repeat):
+    times = []
+    for _ in range(repeat):
+        browser.HTTP_CACHE.clear()
+        browser.CONNECTION_POOL.close_all()
+        start = time.perf_counter()
+        fetch()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times) * 1000
+
+def bench_pipeline(rtts=(0, 0.02), counts=(2, 8), repeat=9):
+    print("same-origin subresources from server.py: sequential vs pipelined")
+    for rtt in rtts:
+        port = start_guest_book(rtt)
+        top = "http://localhost:{}/".format(port)
+        for count in counts:
+            urls = [top + ["comment.css", "comment.js"][i % 2]
+                    for i in range(count)]
+            sequential = time_fetches(lambda: [
+                browser.request(url, top) for url in urls], repeat)
+            pipelined = time_fetches(lambda: browser.request_batch(
+                urls, top), repeat)
+            print("  {:2.0f} ms rtt, {} requests: sequential {:6.2f} ms, "
+                  "pipelined {:6.2f} ms ({:.1f}x)".format(
+                rtt * 1000, count, sequential, pipelined,
+                sequential / pipelined))
+
+# A page whose stylesheet and script can be cached for an hour; counts
+# the connections it gets and the requests for those three files
+def start_cacheable_site(rtt, rules):
+    counts = {"connections": 0, "requests": 0}
+    stylesheet = "".join("p.c{} {{ color: blue; margin-left: {}px }}\n".format(
+        i, i % 40) for i in range(rules))
+    bodies = {
+        "/": (generate_page(20).replace("/comment.css", "/style.css").replace(
+            "<body>", "<body><script src=/script.js></script>", 1), "no-cache"),
+        "/style.css": (stylesheet, "max-age=3600"),
+        "/script.js": ("var loaded = true;", "max-age=3600"),
+    }
+    def handle(conx):
+        counts["connections"] += 1
+        req = conx.makefile("b")
+        while True:
+            reqline = req.readline()
+            if not reqline: break
+            while req.readline() not in [b"\r\n", b""]: pass
+            path = reqline.split()[1].decode("utf8")
+            if path in bodies:
+                counts["requests"] += 1
+                status, (body, cache) = "200 OK", bodies[path]
+            else:
+                # the page's links, which get prefetched
+                status, body, cache = "404 Not Found", "", "no-store"
+            body = body.encode("utf8")
+            conx.sendall("HTTP/1.1 {}\r\nContent-Length: {}\r\n"
+                "Cache-Control: {}\r\n\r\n".format(status, len(body), cache)
+                .encode("utf8") + body)
+        conx.close()
+    return start_behind_proxy(handle, rtt), counts, stylesheet
+
+class NoBrowser:
+    def load(self, url, activate=True): pass
+    def share_cookies(self, cookies, tab): pass
+
+def wait_for_load(tab):
+    while tab.loading:
+        tab.receive()
+        time.sleep(0.001)
+
+def open_tab_processes(url, tabs):
+    times = []
+    processes = []
+    for _ in range(tabs):
+        tab = browser.TabProcess(NoBrowser())
+        processes.append(tab)
+        # the process has started once it's loaded a local page
+        tab.load("about:bookmarks")
+        wait_for_load(tab)
+        start = time.perf_counter()
+        tab.load(url)
+        wait_for_load(tab)
+        times.append(time.perf_counter() - start)
+    for tab in processes:
+        tab.close()
+    return times
+
+def open_tabs(url, tabs):
+    times = []
+    for _ in range(tabs):
+        start = time.perf_counter()
+        browser.Tab(None).load(url)
+        times.append(time.perf_counter() - start)
+    return times
+
+def bench_tab_processes(tabs=4, rtt=0.02, rules=2000):
+    browser.set_font_backend(browser.FixedFontBackend())
+    cache_dir = tempfile.mkdtemp()
+    print("opening {} tabs on one page ({} ms rtt, cacheable {}-rule "
+          "stylesheet and script)".format(tabs, rtt * 1000, rules))
+    ways = [
+        ("in this process", None, open_tabs),
+        ("tab processes, no shared cache", None, open_tab_processes),
+        ("tab processes, shared disk cache", cache_dir, open_tab_processes),
+    ]
+    for name, disk_dir, open_all in ways:
+        port, counts, stylesheet = start_cacheable_site(rtt, rules)
+        browser.HTTP_CACHE.clear()
+        browser.set_http_cache_dir(disk_dir)
+        browser.CONNECTION_POOL.close_all()
+        times = open_all("http://localhost:{}/".format(port), tabs)
+        print("  {}: {} requests, {} connections; first tab {:.0f} ms, "
+              "later tabs {:.0f} ms".format(name, counts["requests"],
+              counts["connections"], times[0] * 1000,
+              statistics.median(times[1:]) * 1000))
+    browser.HTTP_CACHE.clear()
+    browser.set_http_cache_dir(None)
+    os.rmdir(cache_dir)
+    # what a tab process still redoes that in-process tabs share
+    times = []
+    for _ in range(5):
+        start = time.perf_counter()
+        browser.CSSParser(stylesheet).parse()
+        times.append(time.perf_counter() - start)
+    print("  each tab process parses the stylesheet again: {:.1f} ms".format(
+        statistics.median(times) * 1000))
+
+BENCHMARKS = {
+    "parse": bench_html_parser,
+    "memory": bench_dom_memory,
+    "keystroke": bench_keystroke,
+    "fonts": bench_font_cache,
+    "scroll": bench_scroll,
+    "frame": bench_frame,
+    "composite": bench_composite,
+    "lines": bench_line_breaking,
+    "pipeline": bench_pipeline,
+    "tabs": bench_tab_processes,
+}
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
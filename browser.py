@@ -1,17 +1,41 @@
 from ast import Tuple
+import dataclasses
 from dataclasses import dataclass
 import re
+import math
+import bisect
+import itertools
 import socket
 import ssl
 import time
+import types
+import zlib
+import collections
+import hashlib
+import email.utils
+import json
+import queue
+import base64
+import os
+import codecs
+import concurrent.futures
+import threading
+import multiprocessing
+import traceback
+import tempfile
+import shutil
+import atexit
 import tkinter
 import tkinter.font
 from typing import List, Union
 import sys
 import urllib.parse
 import dukpy
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-cached_urls = {}
 WIDTH, HEIGHT = 800, 600
 HSTEP, VSTEP = 13, 18
 SCROLL_STEP = 100
@@ -39,33 +63,214 @@ BLOCK_ELEMENTS = [
     "legend", "details", "summary"
 ]
 COOKIE_JAR = {}
-
-def request(url, top_level_url, payload=None, headers=None, redirects=0, referrer_policy=None):
+CONTENT_ENCODINGS = ["identity", "gzip", "deflate"]
+MAX_SUBRESOURCE_FETCHES = 6
+MAX_CACHED_STYLESHEETS = 32
+MAX_CACHED_WIDTHS = 50000
+# text runs at least this many words long are broken into lines with numpy
+MIN_VECTOR_WORDS = 64
+TILE_HEIGHT = 256
+# rasterized layers kept by a Compositor; each is WIDTH x TILE_HEIGHT pixels
+MAX_RASTER_LAYERS = 32
+FRAME_SAMPLES = 120
+MAX_BFCACHE_BYTES = 64 * 1024 * 1024
+# rough memory use of a loaded page, measured with tracemalloc: layout
+# objects and draw commands cost far more than the DOM
+PAGE_BYTES_PER_NODE = 100
+PAGE_BYTES_PER_COMMAND = 550
+# run each tab's loading, layout and scripts in its own process. Tab
+# processes share HTTP responses through the HTTP cache's disk tier (a
+# directory for the session if HTTP_CACHE_DIR isn't set), but each has
+# its own keep-alive connections, DNS cache, parsed stylesheets, font
+# metrics and back-forward cache budget; "python benchmark.py tabs"
+# measures what that costs
+TAB_PROCESSES = True
+# target time between animation frames, about 60 a second
+FRAME_MS = 16
+CHUNK_SIZE = 16384
+MAX_CACHE_BYTES = 16 * 1024 * 1024
+MAX_DISK_CACHE_BYTES = 64 * 1024 * 1024
+HEURISTIC_FRESHNESS_CAP = 24 * 60 * 60
+# a directory to keep the HTTP cache in across restarts; to change it
+# once the browser is imported, use set_http_cache_dir
+HTTP_CACHE_DIR = None
+DNS_TTL = 60
+DNS_NEGATIVE_TTL = 10
+MAX_CACHED_HOSTS = 256
+# per page load; 0 turns that kind of speculation off
+MAX_PRECONNECTS = 2
+MAX_PREFETCHES = 4
+PREFETCH_LIFETIME = 5 * 60
+
+def request(url, top_level_url, payload=None, headers=None, redirects=0, referrer_policy=None, stream=None, raw=False, prefetch=False):
     # if too many redirects, raise an exception
     init_url = url
     if redirects > 8:
         raise Exception("Too many redirects")
-    # if url is in cache, return the cached value
-    if init_url in cached_urls:
-        if cached_urls[init_url][0] > time.time():
-            return cached_urls[init_url][1], cached_urls[init_url][2]
+    # if url is in cache and still fresh, return the cached value;
+    # a stale entry with validators is revalidated below
+    entry = None
+    if not payload:
+        entry = HTTP_CACHE.lookup(init_url)
+        if entry and entry.is_fresh():
+            HTTP_CACHE.count_hit()
+            if entry.prefetched and not prefetch:
+                HTTP_CACHE.used_prefetch(entry)
+            return entry.headers, response_body(entry.headers, entry.body, raw), \
+                init_url.startswith("https://")
     
     if url == "about:bookmarks":
         html = "<!doctype html>\n"
         for bookmark in BOOKMARKS:
             html += "<a href=\"{}\">{}</a><br>\n".format(bookmark, bookmark)
-        return {}, html
+        return {}, html.encode("utf8") if raw else html, False
 
     # split url and check for scheme
-    scheme, url = url.split("://", 1)
-    assert scheme in ["http", "https", "file"], \
-        "Unknown scheme {}".format(scheme)
+    scheme, host, port, path = split_url(url)
 
     # handle file scheme
     if scheme == "file":
-        with open(url, "r") as f:
-            return {}, f.read(), False
+        with open(path, "rb") as f:
+            return {}, response_body({}, f.read(), raw), False
+
+    method = "POST" if payload else "GET"
+    req = request_text(method, host, path, top_level_url, headers, payload,
+                       referrer_policy, entry).encode("utf8")
+
+    # get a (possibly reused) connection and send the request
+    try:
+        conn, reused = CONNECTION_POOL.get(scheme, host, port)
+        statusline = conn.send(req)
+        if not statusline and reused:
+            # the server closed the idle connection, so retry on a fresh one
+            conn.close()
+            conn = CONNECTION_POOL.connect(scheme, host, port)
+            statusline = conn.send(req)
+    except ssl.SSLError:
+        html = "<!doctype html>\n Secure Connection Failed"
+        return {}, html.encode("utf8") if raw else html, False
+
+    # read the response, streaming a successful body to the caller if
+    # asked, and keep the connection if the server will
+    version, status, explanation, cur_headers, body, keep_alive = \
+        read_response(conn, host, statusline, stream)
+    if keep_alive:
+        CONNECTION_POOL.put(scheme, host, port, conn)
+    else:
+        conn.close()
+    assert status == "200" or (status >= "300" and status < "400"), "{}: {}".format(status, explanation)
+    
+    if "referer" in cur_headers:
+        top_level_url = cur_headers["referer"]
+    
+    # our cached copy is still good
+    if status == "304":
+        if not entry:
+            raise Exception("{} answered 304 Not Modified, but there's no cached copy".format(init_url))
+        entry = HTTP_CACHE.revalidated(init_url, entry, cur_headers)
+        return entry.headers, response_body(entry.headers, entry.body, raw), \
+            scheme == "https"
+
+    # handle redirects
+    if status >= "300" and status < "400":
+        location = cur_headers["location"]
+        if not location.startswith(scheme): 
+            location = scheme + "://" + host + location
+        return request(location, top_level_url, headers=headers,
+            redirects=redirects + 1, referrer_policy=referrer_policy,
+            stream=stream, raw=raw, prefetch=prefetch)
     
+    if method == "GET":
+        HTTP_CACHE.count_miss()
+        HTTP_CACHE.store(init_url, cur_headers, body, prefetch)
+
+    return cur_headers, response_body(cur_headers, body, raw), scheme == "https"
+
+def request_batch(urls, top_level_url, headers=None, referrer_policy=None, raw=False,
+                  on_result=None):
+    # GETs for one origin, pipelined over a single keep-alive connection:
+    # all the requests go out at once and the responses come back in
+    # order. Anything that isn't a 200 or 304, or that the server hung up
+    # before answering, is fetched again with request() afterwards.
+    # on_result(i, result) hears about each response as soon as it's in.
+    results = [None] * len(urls)
+    pending = []
+    for i, url in enumerate(urls):
+        entry = HTTP_CACHE.lookup(url)
+        if entry and entry.is_fresh():
+            HTTP_CACHE.count_hit()
+            if entry.prefetched:
+                HTTP_CACHE.used_prefetch(entry)
+            results[i] = (entry.headers, response_body(entry.headers, entry.body, raw),
+                          url.startswith("https://"))
+            if on_result: on_result(i, results[i])
+        else:
+            pending.append((i, url, entry))
+
+    if len(pending) > 1:
+        scheme, host, port, _ = split_url(pending[0][1])
+        assert scheme in ["http", "https"]
+        reqs = []
+        for _, url, entry in pending:
+            assert split_url(url)[:3] == (scheme, host, port), \
+                "Can't pipeline {} with {}".format(url, pending[0][1])
+            reqs.append(request_text("GET", host, split_url(url)[3],
+                top_level_url, headers, None, referrer_policy, entry))
+        reqs = "".join(reqs).encode("utf8")
+        try:
+            conn, reused = CONNECTION_POOL.get(scheme, host, port)
+            statusline = conn.send(reqs)
+            if not statusline and reused:
+                conn.close()
+                conn = CONNECTION_POOL.connect(scheme, host, port)
+                statusline = conn.send(reqs)
+        except ssl.SSLError:
+            # request() below reports it, one URL at a time
+            conn, statusline = None, ""
+
+        answered = 0
+        keep_alive = bool(statusline)
+        while keep_alive and answered < len(pending):
+            i, url, entry = pending[answered]
+            if answered:
+                statusline = conn.readline()
+            try:
+                version, status, explanation, cur_headers, body, keep_alive = \
+                    read_response(conn, host, statusline)
+            except (ConnectionError, OSError, ValueError):
+                keep_alive = False
+                break
+            answered += 1
+            if status == "304" and entry:
+                entry = HTTP_CACHE.revalidated(url, entry, cur_headers)
+                results[i] = (entry.headers, response_body(entry.headers, entry.body, raw),
+                              scheme == "https")
+            elif status == "200":
+                HTTP_CACHE.count_miss()
+                HTTP_CACHE.store(url, cur_headers, body)
+                results[i] = (cur_headers, response_body(cur_headers, body, raw),
+                              scheme == "https")
+            if on_result and results[i]: on_result(i, results[i])
+        if keep_alive:
+            CONNECTION_POOL.put(scheme, host, port, conn)
+        elif conn:
+            conn.close()
+
+    # fall back to one request at a time for the rest
+    for i, url, _ in pending:
+        if results[i] is None:
+            results[i] = request(url, top_level_url, headers=headers,
+                referrer_policy=referrer_policy, raw=raw)
+            if on_result: on_result(i, results[i])
+    return results
+
+def split_url(url):
+    # "http://host:8000/a/b" -> ("http", "host", 8000, "/a/b")
+    scheme, url = url.split("://", 1)
+    assert scheme in ["http", "https", "file"], \
+        "Unknown scheme {}".format(scheme)
+    if scheme == "file":
+        return scheme, None, None, url
     host, path = url.split("/", 1)
     path = "/" + path
     port = 80 if scheme == "http" else 443
@@ -73,33 +278,19 @@ def request(url, top_level_url, payload=None, headers=None, redirects=0, referre
     if ":" in host:
         host, port = host.split(":", 1)
         port = int(port)
+    return scheme, host, port, path
 
-    # connect to host and send request
-    s = socket.socket(
-        family=socket.AF_INET,
-        type=socket.SOCK_STREAM,
-        proto=socket.IPPROTO_TCP,
-    )
-    s.connect((host, port))
-    
-    # wrap socket if using https
-    if scheme == "https":
-        ctx = ssl.create_default_context()
-        try:
-            s = ctx.wrap_socket(s, server_hostname=host)
-        except:
-            return {}, "<!doctype html>\n Secure Connection Failed", False
-
+def request_text(method, host, path, top_level_url, headers=None, payload=None,
+                 referrer_policy=None, entry=None):
     # check for user-input headers
     if headers is None:
         headers = {"User-Agent": "Chrome/112.0.5615.45"}
     
-    method = "POST" if payload else "GET"
-    
     # create request string and update headers within it
     req = "{} {} HTTP/1.1\r\n".format(method, path) + \
         "Host: {}\r\n".format(host) + \
-        "Connection: close\r\n"
+        "Connection: keep-alive\r\n" + \
+        "Accept-Encoding: gzip, deflate\r\n"
     for header, value in headers.items():
         if header.lower() not in req:
             req += "{}: {}\r\n".format(header, value)
@@ -130,28 +321,54 @@ def request(url, top_level_url, payload=None, headers=None, redirects=0, referre
         if allow_cookie:
             req += "Cookie: {}\r\n".format(cookie)
 
-    req += "\r\n" + (payload if payload else "")
+    if entry:
+        for header, value in entry.validators().items():
+            req += "{}: {}\r\n".format(header, value)
 
-    s.send(req.encode("utf8"))
-    response = s.makefile("r", encoding="utf8", newline="\r\n")
+    return req + "\r\n" + (payload if payload else "")
 
-    # read status line and check for errors
-    statusline = response.readline()
+def read_response(conn, host, statusline, stream=None):
+    # read status line
     version, status, explanation = statusline.split(" ", 2)
-    assert status == "200" or (status >= "300" and status < "400"), "{}: {}".format(status, explanation)
 
     # read headers
     cur_headers = {}
     while True:
-        line = response.readline()
+        line = conn.readline()
         if line == "\r\n":
             break
         header, value = line.split(":", 1)
         cur_headers[header.lower()] = value.strip()
-    
-    if "referer" in cur_headers:
-        top_level_url = cur_headers["referer"]
 
+    chunked = cur_headers.get("transfer-encoding", "").lower() == "chunked"
+    assert chunked or "transfer-encoding" not in cur_headers
+    assert cur_headers.get("content-encoding", "identity").lower() \
+        in CONTENT_ENCODINGS
+
+    # a streamed body starts subresource fetches, which need the cookie
+    # this response sets
+    store_cookie(host, cur_headers)
+
+    # if streaming, hand each piece of a successful body to the caller
+    # as it arrives
+    on_chunk = None
+    if stream and status == "200":
+        on_chunk = lambda chunk: stream(cur_headers, chunk)
+
+    # read the body by content-length or chunks so the connection can be
+    # reused; only a body that runs to EOF uses it up. 1xx, 204 and 304
+    # responses never have one, whatever their headers say.
+    no_body = status.startswith("1") or status in ["204", "304"]
+    if no_body:
+        body = b""
+    else:
+        body = conn.read_body(cur_headers, on_chunk)
+    keep_alive = version == "HTTP/1.1" and \
+        cur_headers.get("connection", "").lower() != "close" and \
+        (no_body or chunked or "content-length" in cur_headers)
+    return version, status, explanation, cur_headers, body, keep_alive
+
+def store_cookie(host, cur_headers):
     if "set-cookie" in cur_headers:
         params = {}
         if ";" in cur_headers["set-cookie"]:
@@ -166,30 +383,653 @@ def request(url, top_level_url, payload=None, headers=None, redirects=0, referre
         else:
             cookie = cur_headers["set-cookie"]
         COOKIE_JAR[host] = (cookie, params)
-    
-    # handle redirects
-    if status >= "300" and status < "400":
-        location = cur_headers["location"]
-        if not location.startswith(scheme): 
-            location = scheme + "://" + host + location
-        return request(location, headers, redirects + 1)
-    
-    assert "transfer-encoding" not in cur_headers
-    assert "content-encoding" not in cur_headers
 
-    body = response.read()
-    s.close()
-    
-    # check for cache-control header
-    if "cache-control" in cur_headers:
-        if "no-store" in cur_headers["cache-control"]:
-            return cur_headers, body, scheme == "https"
-        if "max-age" in cur_headers["cache-control"]:
-            max_age = int(cur_headers["cache-control"].split("=", 1)[1])
-            cur_time = time.time() + max_age
-            cached_urls[init_url] = (cur_time, cur_headers, body)
+def response_charset(headers):
+    # "text/html; charset=ISO-8859-1" -> "iso8859-1"; utf8 if missing or
+    # unknown
+    for param in headers.get("content-type", "").split(";")[1:]:
+        name, _, value = param.strip().partition("=")
+        if name.lower() == "charset":
+            try:
+                return codecs.lookup(value.strip().strip("\"'")).name
+            except LookupError:
+                break
+    return "utf8"
+
+def decode_body(headers, data):
+    return str(data, response_charset(headers), "replace")
+
+def response_body(headers, data, raw):
+    # bodies are bytes until someone asks for text; raw callers get the
+    # (shared, read-only by convention) bytes themselves
+    return data if raw else decode_body(headers, data)
+
+def parse_cache_control(value):
+    # "max-age=60, no-cache, private=\"set-cookie\"" ->
+    # {"max-age": "60", "no-cache": True, "private": "set-cookie"}
+    directives = {}
+    for part in re.findall(r'(?:[^,"]|"[^"]*")+', value):
+        if "=" in part:
+            name, arg = part.split("=", 1)
+            directives[name.strip().lower()] = arg.strip().strip('"')
+        elif part.strip():
+            directives[part.strip().lower()] = True
+    return directives
+
+def parse_http_date(value):
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+def parse_seconds(value):
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return None
+
+@dataclass
+class CacheEntry:
+    url: str
+    headers: dict
+    body: bytes
+    response_time: float
+    prefetched: bool = False
+
+    @property
+    def size(self):
+        return len(self.body) + sum(len(k) + len(v) for k, v in self.headers.items())
+
+    def cache_control(self):
+        return parse_cache_control(self.headers.get("cache-control", ""))
+
+    def freshness_lifetime(self):
+        directives = self.cache_control()
+        max_age = parse_seconds(directives.get("max-age"))
+        # a speculative fetch is good for a while, so following the link
+        # can use it, unless the server said to never reuse it as is
+        if self.prefetched and max_age != 0 and "no-cache" not in directives:
+            return max(max_age or 0, PREFETCH_LIFETIME)
+        if max_age is not None:
+            return max_age
+        date = parse_http_date(self.headers.get("date")) or self.response_time
+        if "expires" in self.headers:
+            expires = parse_http_date(self.headers["expires"])
+            return max(0, expires - date) if expires else 0
+        # heuristic freshness: 10% of the time since it last changed
+        last_modified = parse_http_date(self.headers.get("last-modified"))
+        if last_modified and last_modified < date:
+            return min((date - last_modified) / 10, HEURISTIC_FRESHNESS_CAP)
+        return 0
+
+    def current_age(self):
+        date = parse_http_date(self.headers.get("date"))
+        apparent_age = max(0, self.response_time - date) if date else 0
+        age = parse_seconds(self.headers.get("age")) or 0
+        return max(apparent_age, age) + (time.time() - self.response_time)
+
+    def is_fresh(self):
+        directives = self.cache_control()
+        if "no-cache" in directives:
+            return False
+        return self.freshness_lifetime() > self.current_age()
+
+    def validators(self):
+        headers = {}
+        if "etag" in self.headers:
+            headers["If-None-Match"] = self.headers["etag"]
+        if "last-modified" in self.headers:
+            headers["If-Modified-Since"] = self.headers["last-modified"]
+        return headers
+
+# HTTP cache for GET responses: an LRU memory tier with a byte budget and
+# an optional on-disk tier (one JSON file per URL) that survives
+# restarts. Stale entries with an ETag or Last-Modified are kept so they
+# can be revalidated with a conditional GET.
+class HTTPCache:
+    def __init__(self, max_bytes=MAX_CACHE_BYTES, disk_dir=None,
+                 max_disk_bytes=MAX_DISK_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.lock = threading.Lock()
+        self.set_disk_dir(disk_dir)
+
+    def set_disk_dir(self, disk_dir):
+        # the disk tier's files (path -> size), oldest written first, so
+        # trimming it doesn't have to list the directory. Tab processes
+        # sharing a directory each trim what they found there or wrote.
+        self.disk_dir = disk_dir
+        self.disk_files = collections.OrderedDict()
+        self.disk_bytes = 0
+        if not disk_dir: return
+        os.makedirs(disk_dir, exist_ok=True)
+        paths = [os.path.join(disk_dir, name)
+                 for name in os.listdir(disk_dir) if name.endswith(".json")]
+        paths.sort(key=os.path.getmtime)
+        for path in paths:
+            self.disk_files[path] = os.path.getsize(path)
+            self.disk_bytes += self.disk_files[path]
+
+    def lookup(self, url):
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry:
+                self.entries.move_to_end(url)
+                return entry
+        entry = self.read_disk(url)
+        if entry:
+            self.remember(entry)
+        return entry
+
+    def count_hit(self):
+        self.hits += 1
+
+    def count_miss(self):
+        self.misses += 1
+
+    def store(self, url, headers, body, prefetched=False):
+        directives = parse_cache_control(headers.get("cache-control", ""))
+        if "no-store" in directives or headers.get("vary") == "*":
+            self.remove(url)
+            return
+        entry = CacheEntry(url, headers, body, time.time(), prefetched)
+        if entry.freshness_lifetime() <= 0 and not entry.validators():
+            self.remove(url)
+            return
+        self.remember(entry)
+        self.write_disk(entry)
+
+    def used_prefetch(self, entry):
+        # a prefetch's extra lifetime only covers the navigation it was
+        # fetched for; after that the entry is as fresh as its headers say
+        entry = dataclasses.replace(entry, prefetched=False)
+        if entry.freshness_lifetime() <= 0 and not entry.validators():
+            self.remove(entry.url)
+            return
+        self.remember(entry)
+        self.write_disk(entry)
+
+    def revalidated(self, url, entry, headers):
+        # a 304 refreshes the stored headers and the response time
+        self.revalidations += 1
+        merged = dict(entry.headers)
+        for name, value in headers.items():
+            if name not in ["content-length", "connection"]:
+                merged[name] = value
+        entry = CacheEntry(url, merged, entry.body, time.time())
+        self.remember(entry)
+        self.write_disk(entry)
+        return entry
+
+    def remember(self, entry):
+        with self.lock:
+            old = self.entries.pop(entry.url, None)
+            if old:
+                self.bytes -= old.size
+            if entry.size > self.max_bytes:
+                return
+            self.entries[entry.url] = entry
+            self.bytes += entry.size
+            while self.bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.bytes -= evicted.size
+
+    def remove(self, url):
+        with self.lock:
+            old = self.entries.pop(url, None)
+            if old:
+                self.bytes -= old.size
+        path = self.disk_path(url)
+        if path:
+            remove_file(path)
+            with self.lock:
+                self.disk_bytes -= self.disk_files.pop(path, 0)
+
+    def disk_path(self, url):
+        if not self.disk_dir: return None
+        name = hashlib.sha1(url.encode("utf8")).hexdigest() + ".json"
+        return os.path.join(self.disk_dir, name)
+
+    def read_disk(self, url):
+        path = self.disk_path(url)
+        if not path or not os.path.exists(path): return None
+        try:
+            with open(path, encoding="utf8") as f:
+                fields = json.load(f)
+            fields["body"] = base64.b64decode(fields["body"])
+            entry = CacheEntry(**fields)
+        except (OSError, ValueError, TypeError, KeyError):
+            return None
+        return entry if entry.url == url else None
+
+    def write_disk(self, entry):
+        path = self.disk_path(entry.url)
+        if not path: return
+        fields = dataclasses.asdict(entry)
+        fields["body"] = base64.b64encode(entry.body).decode("ascii")
+        data = json.dumps(fields)
+        # tab processes share the directory, so nobody may read a file
+        # that's half written
+        temp = "{}.{}.tmp".format(path, os.getpid())
+        with open(temp, "w", encoding="utf8") as f:
+            f.write(data)
+        os.replace(temp, path)
+        with self.lock:
+            self.disk_bytes -= self.disk_files.pop(path, 0)
+            self.disk_files[path] = len(data.encode("utf8"))
+            self.disk_bytes += self.disk_files[path]
+        self.trim_disk()
+
+    def trim_disk(self):
+        with self.lock:
+            evicted = []
+            while self.disk_files and self.disk_bytes > self.max_disk_bytes:
+                path, size = self.disk_files.popitem(last=False)
+                self.disk_bytes -= size
+                evicted.append(path)
+        for path in evicted:
+            remove_file(path)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+        if self.disk_dir:
+            for name in os.listdir(self.disk_dir):
+                if name.endswith(".json"):
+                    remove_file(os.path.join(self.disk_dir, name))
+            with self.lock:
+                self.disk_files.clear()
+                self.disk_bytes = 0
+
+    def __repr__(self):
+        return "HTTPCache(entries={}, bytes={}, hits={}, misses={}, revalidations={})".format(
+            len(self.entries), self.bytes, self.hits, self.misses, self.revalidations)
+
+def remove_file(path):
+    # another tab process may have removed it first
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+HTTP_CACHE = HTTPCache(disk_dir=HTTP_CACHE_DIR)
 
-    return cur_headers, body, scheme == "https"
+def set_http_cache_dir(disk_dir):
+    global HTTP_CACHE_DIR
+    HTTP_CACHE_DIR = disk_dir
+    HTTP_CACHE.set_disk_dir(disk_dir)
+
+# A keep-alive socket plus its buffered reader
+class Connection:
+    def __init__(self, sock):
+        self.sock = sock
+        self.file = sock.makefile("rb")
+        # body bytes are read into this buffer, which is reused for every
+        # piece of every response on the connection
+        self.scratch = memoryview(bytearray(CHUNK_SIZE))
+
+    def send(self, data):
+        # returns the status line, or "" if the server hung up
+        try:
+            self.sock.sendall(data)
+            return self.readline()
+        except (ConnectionError, OSError):
+            return ""
+
+    def readline(self):
+        return self.file.readline().decode("utf8")
+
+    def body_chunks(self, headers):
+        # the raw body bytes as they arrive, with any chunking undone
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            while True:
+                size_line = self.file.readline()
+                size = int(size_line.split(b";", 1)[0].strip(), 16)
+                if size == 0: break
+                yield from self.exactly(size)
+                self.file.readline()
+            # skip any trailer fields
+            while self.file.readline() not in [b"\r\n", b"\n", b""]:
+                pass
+        elif "content-length" in headers:
+            yield from self.exactly(int(headers["content-length"]))
+        else:
+            while True:
+                size = self.file.readinto1(self.scratch)
+                if not size: break
+                yield self.scratch[:size]
+
+    def exactly(self, length):
+        # each piece is a view of the scratch buffer, only good until the
+        # next one is read
+        while length > 0:
+            size = self.file.readinto1(self.scratch[:min(CHUNK_SIZE, length)])
+            if not size:
+                raise ConnectionError("Connection closed mid-response")
+            length -= size
+            yield self.scratch[:size]
+
+    def read_body(self, headers, on_chunk=None):
+        # decompress piece by piece into one bytearray; if streaming, also
+        # decode each piece by the response charset and hand the text to
+        # on_chunk as soon as it's available
+        encoding = headers.get("content-encoding", "identity").lower()
+        content = ContentDecoder(encoding) if encoding != "identity" else None
+        decoder = None
+        if on_chunk:
+            decoder = codecs.getincrementaldecoder(
+                response_charset(headers))("replace")
+        body = bytearray()
+        for data in self.body_chunks(headers):
+            if content:
+                data = content.decompress(data)
+            body += data
+            if decoder:
+                text = decoder.decode(data)
+                if text: on_chunk(text)
+        data = content.flush() if content else b""
+        body += data
+        if decoder:
+            text = decoder.decode(data, True)
+            if text: on_chunk(text)
+        return body
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+# Undoes a gzip or deflate Content-Encoding one piece at a time
+class ContentDecoder:
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self.zlib = None
+        self.pending = b""
+
+    def decompress(self, data):
+        if self.zlib is None:
+            # "deflate" should be zlib-wrapped, but some servers send it
+            # raw; the first two bytes tell which
+            self.pending += data
+            if self.encoding == "deflate" and len(self.pending) < 2:
+                return b""
+            data, self.pending = self.pending, b""
+            if self.encoding == "gzip":
+                wbits = 16 + zlib.MAX_WBITS
+            elif data[0] & 0x0f == 8 and (data[0] << 8 | data[1]) % 31 == 0:
+                wbits = zlib.MAX_WBITS
+            else:
+                wbits = -zlib.MAX_WBITS
+            self.zlib = zlib.decompressobj(wbits)
+        return self.zlib.decompress(data)
+
+    def flush(self):
+        if self.zlib is None:
+            if not self.pending: return b""
+            return zlib.decompress(self.pending, -zlib.MAX_WBITS)
+        return self.zlib.flush()
+
+# HTTP/1.1 keep-alive connections keyed by (scheme, host, port), shared
+# across requests and tabs. TLS sessions are also kept so new https
+# connections to a known host can skip the full handshake.
+class ConnectionPool:
+    def __init__(self, max_idle=6):
+        self.max_idle = max_idle
+        self.idle = {}
+        self.tls_sessions = {}
+        self.ssl_context = None
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, scheme, host, port):
+        key = (scheme, host, port)
+        with self.lock:
+            if self.idle.get(key):
+                self.hits += 1
+                return self.idle[key].pop(), True
+            self.misses += 1
+        return self.connect(scheme, host, port), False
+
+    def connect(self, scheme, host, port):
+        s = socket.socket(
+            family=socket.AF_INET,
+            type=socket.SOCK_STREAM,
+            proto=socket.IPPROTO_TCP,
+        )
+        s.connect((DNS_CACHE.resolve(host), port))
+
+        # wrap socket if using https, resuming the last session if we have one
+        if scheme == "https":
+            if not self.ssl_context:
+                self.ssl_context = ssl.create_default_context()
+            try:
+                s = self.ssl_context.wrap_socket(s, server_hostname=host,
+                    session=self.tls_sessions.get((host, port)))
+            except:
+                s.close()
+                raise
+            self.tls_sessions[(host, port)] = s.session
+        return Connection(s)
+
+    def preconnect(self, scheme, host, port):
+        # open a connection ahead of time unless one is already waiting
+        with self.lock:
+            if self.idle.get((scheme, host, port)): return
+        self.put(scheme, host, port, self.connect(scheme, host, port))
+
+    def put(self, scheme, host, port, conn):
+        with self.lock:
+            conns = self.idle.setdefault((scheme, host, port), [])
+            if len(conns) < self.max_idle:
+                conns.append(conn)
+                return
+        conn.close()
+
+    def close_all(self):
+        with self.lock:
+            for conns in self.idle.values():
+                for conn in conns:
+                    conn.close()
+            self.idle = {}
+
+    def __repr__(self):
+        return "ConnectionPool(hits={}, misses={}, idle={})".format(
+            self.hits, self.misses, sum(len(c) for c in self.idle.values()))
+
+CONNECTION_POOL = ConnectionPool()
+
+# Looks hosts up with the system resolver. getaddrinfo doesn't report
+# record TTLs, so every answer gets DNS_TTL.
+class SystemResolver:
+    def resolve(self, host):
+        infos = socket.getaddrinfo(host, None, socket.AF_INET, socket.SOCK_STREAM)
+        return [info[4][0] for info in infos], DNS_TTL
+
+# Answers from a fixed {host: [address, ...]} table, for testing offline
+class StubResolver:
+    def __init__(self, table, ttl=DNS_TTL):
+        self.table = table
+        self.ttl = ttl
+        self.lookups = []
+
+    def resolve(self, host):
+        self.lookups.append(host)
+        if host not in self.table:
+            raise socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+        return list(self.table[host]), self.ttl
+
+# Resolved addresses by host, kept for their TTL. Failed lookups are
+# remembered for DNS_NEGATIVE_TTL so a dead host isn't looked up on every
+# request, and a lookup already under way (say, a prefetch) is waited on
+# rather than repeated.
+class DNSCache:
+    def __init__(self, resolver, max_entries=MAX_CACHED_HOSTS):
+        self.resolver = resolver
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.pending = {}
+        self.prefetcher = None
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def resolve(self, host):
+        with self.lock:
+            entry = self.entries.get(host)
+            if entry and entry[1] > time.time():
+                self.hits += 1
+                self.entries.move_to_end(host)
+                addresses, _, error = entry
+                if error: raise error
+                return addresses[0]
+            pending = self.pending.get(host)
+            if not pending:
+                # others resolving host meanwhile wait for this lookup
+                self.misses += 1
+                lookup = self.pending[host] = concurrent.futures.Future()
+        if pending:
+            pending.result()
+            return self.resolve(host)
+        try:
+            return self.lookup(host)
+        finally:
+            lookup.set_result(None)
+
+    def lookup(self, host):
+        try:
+            addresses, ttl = self.resolver.resolve(host)
+            error = None
+        except socket.gaierror as e:
+            addresses, ttl, error = None, DNS_NEGATIVE_TTL, e
+        except:
+            with self.lock:
+                self.pending.pop(host, None)
+            raise
+        with self.lock:
+            self.entries[host] = (addresses, time.time() + ttl, error)
+            self.entries.move_to_end(host)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            self.pending.pop(host, None)
+        if error: raise error
+        return addresses[0]
+
+    def prefetch(self, host):
+        # look host up in the background if it isn't already known
+        with self.lock:
+            entry = self.entries.get(host)
+            if host in self.pending or (entry and entry[1] > time.time()):
+                return
+            if not self.prefetcher:
+                self.prefetcher = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=2)
+            self.pending[host] = self.prefetcher.submit(self.quiet_lookup, host)
+
+    def quiet_lookup(self, host):
+        try:
+            self.lookup(host)
+        except OSError:
+            pass
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __repr__(self):
+        return "DNSCache(entries={}, hits={}, misses={})".format(
+            len(self.entries), self.hits, self.misses)
+
+DNS_CACHE = DNSCache(SystemResolver())
+
+def set_resolver(resolver):
+    DNS_CACHE.resolver = resolver
+    DNS_CACHE.clear()
+
+# Once a page has loaded, opens connections to the origins it links to
+# and prefetches the pages it's likely to go to next into HTTP_CACHE:
+# <link rel=prefetch> first, then same-origin links in document order.
+# <link rel=preconnect> origins are connected to before other linked
+# origins.
+class SpeculativeLoader:
+    def __init__(self, max_preconnects=MAX_PRECONNECTS,
+                 max_prefetches=MAX_PREFETCHES):
+        self.max_preconnects = max_preconnects
+        self.max_prefetches = max_prefetches
+        self.executor = None
+        self.preconnects = 0
+        self.prefetches = 0
+
+    def candidates(self, nodes, url):
+        page = url.split("#", 1)[0]
+        hinted_origins, origins, hinted, same_origin = [], [], [], []
+        for node in tree_to_list(nodes, []):
+            if not isinstance(node, Element) or "href" not in node.attributes:
+                continue
+            href = node.attributes["href"]
+            # skip fragments and mailto:, javascript: and the like
+            if node.tag not in ["a", "link"] or href.startswith("#") or \
+                    ":" in href.split("/", 1)[0] and "://" not in href:
+                continue
+            link = resolve_url(href, url).split("#", 1)[0]
+            if not link.startswith(("http://", "https://")) or link == page:
+                continue
+            if link.count("/") < 3:
+                link += "/"
+            rel = node.attributes.get("rel", "").lower().split()
+            if "preconnect" in rel:
+                hinted_origins.append(url_origin(link))
+            elif node.tag == "link" and "prefetch" in rel:
+                hinted.append(link)
+            elif node.tag == "a":
+                origins.append(url_origin(link))
+                if url_origin(link) == url_origin(url):
+                    same_origin.append(link)
+        origins = [origin for origin in dict.fromkeys(hinted_origins + origins)
+                   if origin != url_origin(url)]
+        links = list(dict.fromkeys(hinted + same_origin))
+        return origins[:self.max_preconnects], links[:self.max_prefetches]
+
+    def start(self, tab, nodes, url):
+        origins, links = self.candidates(nodes, url)
+        origins = [origin for origin in origins if tab.allowed_request(origin + "/")]
+        links = [link for link in links if tab.allowed_request(link)]
+        if not origins and not links: return
+        if not self.executor:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+        for origin in origins:
+            self.executor.submit(self.preconnect, origin)
+        for link in links:
+            self.executor.submit(self.prefetch, link, url, tab.referrer_policy)
+
+    def preconnect(self, origin):
+        scheme, host, port, _ = split_url(origin + "/")
+        try:
+            CONNECTION_POOL.preconnect(scheme, host, port)
+            self.preconnects += 1
+        except OSError:
+            pass
+
+    def prefetch(self, link, url, referrer_policy):
+        entry = HTTP_CACHE.lookup(link)
+        if entry and entry.is_fresh(): return
+        try:
+            request(link, url, referrer_policy=referrer_policy, raw=True,
+                    prefetch=True)
+            self.prefetches += 1
+        except Exception:
+            pass
+
+    def __repr__(self):
+        return "SpeculativeLoader(preconnects={}, prefetches={})".format(
+            self.preconnects, self.prefetches)
+
+SPECULATIVE_LOADER = SpeculativeLoader()
 
 def resolve_url(url, current):
     if "://" in url:
@@ -209,13 +1049,32 @@ def resolve_url(url, current):
             dir, _ = dir.rsplit("/", 1)
         return dir + "/" + url
 
-# Element and Text classes for the HTML document tree
+# Element and Text classes for the HTML document tree. Nodes use
+# __slots__ and share empty attribute/children objects to keep big
+# documents small; use set_attribute() to change an element's attributes.
+EMPTY_ATTRIBUTES = types.MappingProxyType({})
+EMPTY_CHILDREN = ()
+
+# Dirty bits on DOM nodes: PAINT_DIRTY nodes only need repainting (e.g. an
+# input's value changed), LAYOUT_DIRTY nodes need their subtree restyled
+# and their containing block laid out again.
+PAINT_DIRTY = 1
+LAYOUT_DIRTY = 2
+
 class Element:
+    __slots__ = ["tag", "children", "parent", "attributes", "style", "dirty"]
+
     def __init__(self, tag, attributes, parent):
-        self.tag = tag
+        self.tag = sys.intern(tag)
         self.children = []
         self.parent = parent
-        self.attributes = attributes
+        self.attributes = attributes if attributes else EMPTY_ATTRIBUTES
+        self.dirty = 0
+
+    def set_attribute(self, name, value):
+        if self.attributes is EMPTY_ATTRIBUTES:
+            self.attributes = {}
+        self.attributes[name] = value
 
     def __repr__(self):
         attrs = ""
@@ -224,76 +1083,132 @@ class Element:
         return "<" + self.tag + attrs + ">"
 
 class Text:
+    __slots__ = ["text", "parent", "style", "dirty"]
+    children = EMPTY_CHILDREN
+
     def __init__(self, text, parent):
         self.text = text
-        self.children = []
         self.parent = parent
+        self.dirty = 0
 
     def __repr__(self):
         return repr(self.text)
 
 Node = Union[Element, Text]
 
+# characters that can change HTMLParser's state in each scanning mode
+TEXT_SPECIAL_CHARS = re.compile(r"[<>]")
+TAG_SPECIAL_CHARS = re.compile(r"[<>\"']")
+QUOTED_SPECIAL_CHARS = {
+    "\"": re.compile(r"[<\"]"),
+    "'": re.compile(r"[<']"),
+}
+QUOTE_CHARS = re.compile(r"[\"']")
+ATTR_SPECIAL_CHARS = re.compile(r"[ \"']")
+
 class HTMLParser:
-    def __init__(self, body):
-        self.body = body
+    def __init__(self, body="", on_element=None):
+        self.buffer = body
         self.unfinished = []
         self.in_script = False
+        self.on_element = on_element
+
+        self.text = ""
+        self.tag = False
+        self.comment = False
+        self.open_quote = None
     
     def parse(self) -> Node:
-        text = ""
-        tag = False
-        comment = False
-        open_quote = None
+        return self.close()
+
+    # feed() can be called with pieces of the document as they arrive;
+    # close() then returns the same tree parse() would have built
+    def feed(self, chunk):
+        self.buffer += chunk
+        self.scan(False)
+
+    def close(self) -> Node:
+        self.scan(True)
+        if not self.tag and self.text:
+            self.add_text(self.text)
+        self.text = ""
+        return self.finish()
+
+    def scan(self, final):
+        body = self.buffer
+        # "<!--" needs three characters of lookahead, so unless this is
+        # the last chunk leave the tail in the buffer for next time
+        end = len(body) if final else len(body) - 3
+        text = [self.text] if self.text else []
+        tag, comment, open_quote = self.tag, self.comment, self.open_quote
         i = 0
-        while i < len(self.body):
-            c = self.body[i]
-            if tag and (c == "\"" or c == "'"):
+        while i < end:
+            if comment:
+                close = body.find("-->", i, end + 2)
+                stop = close if close >= 0 else end
+                # quotes inside a comment still count if we're in a tag
+                if tag:
+                    for m in QUOTE_CHARS.finditer(body, i, stop):
+                        c = m.group()
+                        if open_quote == c:
+                            open_quote = None
+                        elif not open_quote:
+                            open_quote = c
+                if close >= 0:
+                    comment = False
+                    i = close + 3
+                else:
+                    i = end
+                continue
+
+            # jump straight to the next character that can change state
+            if not tag:
+                special = TEXT_SPECIAL_CHARS
+            elif open_quote:
+                special = QUOTED_SPECIAL_CHARS[open_quote]
+            else:
+                special = TAG_SPECIAL_CHARS
+            m = special.search(body, i, end)
+            if not m:
+                text.append(body[i:end])
+                i = end
+                break
+            if m.start() > i:
+                text.append(body[i:m.start()])
+            i = m.start()
+            c = body[i]
+            if c == "\"" or c == "'":
                 if open_quote == c:
                     open_quote = None
                 elif not open_quote:
                     open_quote = c
-            if not comment and self.body[i:i+4] == "<!--":
-                if text: self.add_text(text)
-                text = ""
+                text.append(c)
+                i += 1
+            elif c == "<" and body.startswith("<!--", i):
+                if text: self.add_text("".join(text))
+                text = []
                 comment = True
                 i += 4
-                continue
-            elif comment and self.body[i:i+3] == "-->":
-                comment = False
-                i += 3
-                continue
-            elif comment:
+            elif open_quote:
+                text.append(c)
                 i += 1
-                continue
-            elif c == "<" and not open_quote:
-                # if self.in_script:
-                #     if self.body[i:i+9] == "</script>":
-                #         self.in_script = False
-                #         i += 9
-                #     else:
-                #         text += c
-                #         i += 1
-                #     continue
+            elif c == "<":
                 tag = True
-                if text: self.add_text(text)
-                text = ""
-            elif c == ">" and not open_quote:
-                # if self.in_script:
-                #     text += c
-                #     i += 1
-                #     continue
-                tag = False
-                self.add_tag(text)
-                text = ""
+                if text: self.add_text("".join(text))
+                text = []
+                i += 1
             else:
-                text += c
-            i += 1
-        if not tag and text:
-            self.add_text(text)
-        return self.finish()
+                tag = False
+                self.add_tag("".join(text))
+                text = []
+                i += 1
+        self.text = "".join(text)
+        self.tag, self.comment, self.open_quote = tag, comment, open_quote
+        self.buffer = body[i:]
 
     def implicit_tags(self, tag):
+        # implicit tags only matter until html, head/body are open
+        if len(self.unfinished) > 2: return
         while True:
             open_tags = [node.tag for node in self.unfinished]
             if open_tags == [] and tag != "html":
@@ -331,6 +1246,7 @@ class HTMLParser:
             parent = self.unfinished[-1]
             node = Element(tag, attributes, parent)
             parent.children.append(node)
+            if self.on_element: self.on_element(node)
         else:
             parent = self.unfinished[-1] if self.unfinished else None
             if tag == "p" and self.open_p():
@@ -346,6 +1262,7 @@ class HTMLParser:
             else:
                 node = Element(tag, attributes, parent)
                 self.unfinished.append(node)
+                if self.on_element: self.on_element(node)
     
     def open_p(self):
         for node in reversed(self.unfinished):
@@ -358,22 +1275,33 @@ class HTMLParser:
         tag = parts[0].lower()
         attrs = []
         if len(parts) > 1:
+            s = parts[1]
             text = ""
             open_quote = None
-            
-            for c in parts[1]:
-                if c == ' ' and not open_quote:
+            i = 0
+            while i < len(s):
+                if open_quote:
+                    end = s.find(open_quote, i)
+                    if end < 0:
+                        text += s[i:]
+                        break
+                    attrs.append(text + s[i:end])
+                    text = ""
+                    open_quote = None
+                    i = end + 1
+                    continue
+                m = ATTR_SPECIAL_CHARS.search(s, i)
+                if not m:
+                    text += s[i:]
+                    break
+                text += s[i:m.start()]
+                if m.group() == " ":
                     if text:
                         attrs.append(text)
                     text = ""
-                elif c == open_quote:
-                    attrs.append(text)
-                    text = ""
-                    open_quote = None
-                elif (c == "'" or c == '"') and not open_quote:
-                    open_quote = c
                 else:
-                    text += c
+                    open_quote = m.group()
+                i = m.end()
 
             if text:
                 attrs.append(text)
@@ -570,6 +1498,39 @@ class CSSParser:
                     break
         return rules
     
+# Parsed stylesheets shared by every tab, keyed by URL plus a hash of the
+# stylesheet text, with least-recently-used entries evicted past the cap.
+# The returned rule lists are shared, so callers must copy before changing.
+class StylesheetCache:
+    def __init__(self, max_entries=MAX_CACHED_STYLESHEETS):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def parse(self, url, data, charset="utf8"):
+        # keyed on the raw bytes, so a hit never decodes the sheet
+        key = (url, hashlib.sha1(data).hexdigest())
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            self.misses += 1
+        rules = CSSParser(str(data, charset, "replace")).parse()
+        with self.lock:
+            self.entries[key] = rules
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return rules
+
+    def __repr__(self):
+        return "StylesheetCache(entries={}, hits={}, misses={})".format(
+            len(self.entries), self.hits, self.misses)
+
+STYLESHEET_CACHE = StylesheetCache()
+
 class TagSelector:
     def __init__(self, tag):
         self.tag = tag
@@ -642,14 +1603,16 @@ def compute_style(node, property, value):
     else:
         return value
 
-def style(node, rules):
+def style(node, rules, shared_styles=None):
+    if shared_styles is None:
+        shared_styles = {}
     node.style = {}
     for property, default_value in INHERITED_PROPERTIES.items():
         if node.parent:
             node.style[property] = node.parent.style[property]
         else:
             node.style[property] = default_value
-    for selector, body in rules:
+    for selector, body in rules.candidates(node):
         if not selector.matches(node): continue
         for property, value in body.items():
             computed_value = compute_style(node, property, value)
@@ -660,13 +1623,51 @@ def style(node, rules):
         for property, value in pairs.items():
             computed_value = compute_style(node, property, value)
             node.style[property] = computed_value
+    # nodes with identical computed styles share one dict
+    node.style = shared_styles.setdefault(
+        frozenset(node.style.items()), node.style)
     for child in node.children:
-        style(child, rules)
+        style(child, rules, shared_styles)
 
 def cascade_priority(rule):
     selector, body = rule
     return selector.priority
 
+# Rules sorted by cascade priority once and bucketed by the tag or class
+# of their rightmost selector, so style() only tries rules that could
+# match a node instead of every rule in every stylesheet.
+class RuleIndex:
+    def __init__(self, rules):
+        self.rules = sorted(rules, key=cascade_priority)
+        self.by_tag = {}
+        self.by_class = {}
+        for order, rule in enumerate(self.rules):
+            selector, body = rule
+            while isinstance(selector, DescendantSelector):
+                selector = selector.descendant
+            if isinstance(selector, TagSelector):
+                self.by_tag.setdefault(selector.tag, []).append((order, rule))
+            else:
+                self.by_class.setdefault(selector.cls, []).append((order, rule))
+
+    def candidates(self, node):
+        if not isinstance(node, Element): return []
+        found = list(self.by_tag.get(node.tag, []))
+        # ClassSelector matches by substring, so test each indexed class
+        classes = node.attributes.get("class", "")
+        if classes:
+            for cls, bucket in self.by_class.items():
+                if cls in classes:
+                    found.extend(bucket)
+        elif "" in self.by_class:
+            found.extend(self.by_class[""])
+        found.sort(key=lambda entry: entry[0])
+        return [rule for order, rule in found]
+
+    def __repr__(self):
+        return "RuleIndex(rules={}, tags={}, classes={})".format(
+            len(self.rules), len(self.by_tag), len(self.by_class))
+
 class BlockLayout:
     def __init__(self, node, parent, previous):
         self.node = node
@@ -675,8 +1676,11 @@ class BlockLayout:
         self.children = []
 
         self.display_list = []
+        self.painted = None
 
     def layout(self):
+        self.children = []
+        self.painted = None
         self.x = self.parent.x
 
         if self.previous:
@@ -687,6 +1691,7 @@ class BlockLayout:
         self.width = self.parent.width if self.node.style.get("width", "auto") == "auto" else float(self.node.style.get("width", "auto"))
 
         mode = layout_mode(self.node)
+        self.mode = mode
         if mode == "block":
             previous = None
             for child in self.node.children:
@@ -732,9 +1737,9 @@ class BlockLayout:
         if self.cursor_x + w > self.width:  
             self.new_line()
         line = self.children[-1]
-        input = InputLayout(node, line, self.previous)
+        input = InputLayout(node, line, self.previous_word)
         line.children.append(input)
-        self.previous = input
+        self.previous_word = input
         font = self.get_font(node)
         self.cursor_x += w + font.measure(" ")
 
@@ -746,21 +1751,24 @@ class BlockLayout:
         return get_font(size, weight, style)
 
     def text(self, node):
-        color = node.style["color"]
         font = self.get_font(node)
-        for word in node.text.split():
-            w = font.measure(word)
-            if self.cursor_x + w > self.width:
-                self.new_line()
-            # self.line.append((self.cursor_x, word, font))
+        words = node.text.split()
+        if not words: return
+        widths = [font.measure(word) for word in words]
+        runs, cursor_x = break_lines(
+            widths, font.measure(" "), self.cursor_x, self.width)
+        for i, (start, end) in enumerate(runs):
+            if i: self.new_line()
             line = self.children[-1]
-            text = TextLayout(node, word, line, self.previous)
-            line.children.append(text)
-            self.previous = text
-            self.cursor_x += w + font.measure(" ")
+            for j in range(start, end):
+                text = TextLayout(node, words[j], line, self.previous_word,
+                                  font, widths[j])
+                line.children.append(text)
+                self.previous_word = text
+        self.cursor_x = cursor_x
     
     def new_line(self):
-        self.previous = None
+        self.previous_word = None
         self.cursor_x = 0
         last_line = self.children[-1] if self.children else None
         new_line = LineLayout(self.node, self, last_line)
@@ -780,6 +1788,19 @@ class BlockLayout:
         self.cursor_y = baseline + 1.25 * max_descent
 
     def paint(self, display_list):
+        # inline blocks keep their commands until they are laid out or
+        # marked dirty again, so repainting a page mostly reuses them
+        if self.painted is not None:
+            display_list.extend(self.painted)
+            return
+        if self.mode == "inline":
+            self.painted = []
+            self.paint_into(self.painted)
+            display_list.extend(self.painted)
+        else:
+            self.paint_into(display_list)
+
+    def paint_into(self, display_list):
         bgcolor = self.node.style.get("background-color",
                                       "transparent")
         if bgcolor != "transparent":
@@ -806,12 +1827,46 @@ class BlockLayout:
         return "{}Layout(x={}, y={}, width={}, height={})".format(
             layout_mode(self.node).capitalize(), self.x, self.y, self.width, self.height)
 
+# Breaks a run of words, each followed by space, into lines width wide,
+# starting at cursor_x on the current line. As when placing words one at
+# a time, a word that would pass the edge starts a new line, even if the
+# current one is empty.
+# With P[i] the total advance of the words before word i, word i on a
+# line starting at word j (at x0) ends at x0 + P[i] - P[j] + widths[i];
+# P[i] + widths[i] never decreases, so each line's break is one binary
+# search. Returns the (start, end) word ranges for the current line and
+# each new one, and the cursor_x after the last word.
+def break_lines(widths, space, cursor_x, width):
+    if numpy is not None and len(widths) >= MIN_VECTOR_WORDS:
+        advances = numpy.cumsum(numpy.asarray(widths, numpy.float64) + space)
+        edges = advances - space
+        def first_past(limit, lo):
+            return lo + int(numpy.searchsorted(edges[lo:], limit, "right"))
+        advances = advances.tolist()
+    else:
+        advances = list(itertools.accumulate(w + space for w in widths))
+        edges = [advance - space for advance in advances]
+        def first_past(limit, lo):
+            return bisect.bisect_right(edges, limit, lo)
+    offsets = [0] + advances
+
+    end = first_past(width - cursor_x, 0)
+    runs = [(0, end)]
+    while end < len(widths):
+        start = end
+        end = first_past(width + offsets[start], start + 1)
+        runs.append((start, end))
+        cursor_x = 0
+    start = runs[-1][0]
+    return runs, cursor_x + offsets[-1] - offsets[start]
+
 class DocumentLayout:
     def __init__(self, node):
         self.node = node
         self.parent = None
         self.previous = None
         self.children = []
+        self.blocks = {}
 
     def layout(self):
         child = BlockLayout(self.node, self, None)
@@ -822,6 +1877,45 @@ class DocumentLayout:
         self.y = VSTEP
         child.layout()
         self.height = child.height + 2*VSTEP
+        self.index_blocks(child)
+
+    def index_blocks(self, layout):
+        for obj in tree_to_list(layout, []):
+            if isinstance(obj, BlockLayout):
+                self.blocks[obj.node] = obj
+
+    def containing_block(self, node):
+        while node not in self.blocks:
+            node = node.parent
+        return self.blocks[node]
+
+    def relayout(self, block):
+        # lay out one block again, then move everything after it and
+        # resize its ancestors instead of laying them out from scratch
+        for obj in tree_to_list(block, [])[1:]:
+            if isinstance(obj, BlockLayout) and self.blocks.get(obj.node) is obj:
+                del self.blocks[obj.node]
+        old_height = block.height
+        block.layout()
+        self.index_blocks(block)
+
+        dy = block.height - old_height
+        child = block
+        while dy:
+            parent = child.parent
+            index = parent.children.index(child)
+            for sibling in parent.children[index + 1:]:
+                shift_layout(sibling, dy)
+            if parent is self:
+                self.height += dy
+                break
+            if parent.node.style.get("height", "auto") == "auto":
+                old_height = parent.height
+                parent.height = sum([c.height for c in parent.children])
+                dy = parent.height - old_height
+            else:
+                dy = 0
+            child = parent
 
     def paint(self, display_list):
         self.children[0].paint(display_list)
@@ -829,6 +1923,14 @@ class DocumentLayout:
     def __repr__(self):
         return "DocumentLayout()"
 
+def shift_layout(layout, dy):
+    for obj in tree_to_list(layout, []):
+        obj.y += dy
+        if isinstance(obj, BlockLayout) and obj.painted:
+            for cmd in obj.painted:
+                cmd.top += dy
+                cmd.bottom += dy
+
 class LineLayout:
     def __init__(self, node, parent, previous):
         self.node = node
@@ -852,13 +1954,14 @@ class LineLayout:
             self.height = 0
             return
 
-        max_ascent = max([word.font.metrics("ascent")
-                  for word in self.children])
+        # a line has many words but few fonts
+        fonts = {word.font.key: word.font for word in self.children}
+        ascents = {key: font.metrics("ascent") for key, font in fonts.items()}
+        max_ascent = max(ascents.values())
         baseline = self.y + 1.25 * max_ascent
         for word in self.children:
-            word.y = baseline - word.font.metrics("ascent")
-        max_descent = max([word.font.metrics("descent")
-                   for word in self.children])
+            word.y = baseline - ascents[word.font.key]
+        max_descent = max([font.metrics("descent") for font in fonts.values()])
         self.height = 1.25 * (max_ascent + max_descent)
     
     def paint(self, display_list):
@@ -870,21 +1973,26 @@ class LineLayout:
             self.x, self.y, self.width, self.height)
 
 class TextLayout:
-    def __init__(self, node, word, parent, previous):
+    def __init__(self, node, word, parent, previous, font=None, width=None):
         self.node = node
         self.word = word
         self.children = []
         self.parent = parent
         self.previous = previous
+        # BlockLayout.text already has these from breaking the line
+        self.font = font
+        self.width = width
     
     def layout(self):
-        weight = self.node.style["font-weight"]
-        style = self.node.style["font-style"]
-        if style == "normal": style = "roman"
-        size = int(float(self.node.style["font-size"][:-2]) * .75)
-        self.font = get_font(size, weight, style)
+        if self.font is None:
+            weight = self.node.style["font-weight"]
+            style = self.node.style["font-style"]
+            if style == "normal": style = "roman"
+            size = int(float(self.node.style["font-size"][:-2]) * .75)
+            self.font = get_font(size, weight, style)
 
-        self.width = self.font.measure(self.word)
+        if self.width is None:
+            self.width = self.font.measure(self.word)
 
         if self.previous:
             space = self.previous.font.measure(" ")
@@ -979,15 +2087,29 @@ class DrawText:
 
         self.bottom = y1 + font.metrics("linespace")
 
-    def execute(self, scroll, canvas):
-        canvas.create_text(
+    def execute(self, scroll, canvas, tags="content"):
+        return canvas.create_text(
             self.left, self.top - scroll,
             text=self.text,
             font=self.font,
             anchor='nw',
             fill=self.color,
+            tags=tags,
         )
 
+    def raster(self, surface, dy):
+        # there's no glyph rasterizer without Tk, so each character is a
+        # box as wide as its advance, from about the x-height to the baseline
+        ascent = self.font.metrics("ascent")
+        top = self.top - dy + ascent * 0.4
+        bottom = self.top - dy + ascent
+        x = self.left
+        for c in self.text:
+            advance = self.font.measure(c)
+            if not c.isspace():
+                surface.fill_rect(x, top, x + advance - 1, bottom, self.color)
+            x += advance
+
     def __repr__(self):
         return "DrawText(top={} left={} bottom={} text={} font={})".format(self.top,
                                     self.left, self.bottom, self.text, self.font)
@@ -1000,22 +2122,414 @@ class DrawRect:
         self.right = x2
         self.color = color
 
-    def execute(self, scroll, canvas):
-        canvas.create_rectangle(
+    def execute(self, scroll, canvas, tags="content"):
+        return canvas.create_rectangle(
             self.left, self.top - scroll,
             self.right, self.bottom - scroll,
             width=0,
             fill=self.color,
+            tags=tags,
         )
 
+    def raster(self, surface, dy):
+        surface.fill_rect(self.left, self.top - dy,
+                          self.right, self.bottom - dy, self.color)
+
     def __repr__(self):
         return "DrawRect(top={} left={} bottom={} right={} color={})".format(
             self.top, self.left, self.bottom, self.right, self.color)
 
+# Memoized font measurements. Every measure() and metrics() call on a Tk
+# font is a round trip into Tk, and layout asks for the same words, spaces
+# and ascents over and over. Word widths are kept in a bounded LRU; each
+# font's metrics are fetched once. hits counts backend calls avoided and
+# misses counts backend calls made.
+class FontMetricsCache:
+    def __init__(self, max_widths=MAX_CACHED_WIDTHS):
+        self.max_widths = max_widths
+        self.widths = collections.OrderedDict()
+        self.font_metrics = {}
+        self.hits = 0
+        self.misses = 0
+
+    def measure(self, font, text):
+        key = (font.key, text)
+        if key in self.widths:
+            self.hits += 1
+            self.widths.move_to_end(key)
+            return self.widths[key]
+        self.misses += 1
+        width = font.raw_measure(text)
+        self.widths[key] = width
+        if len(self.widths) > self.max_widths:
+            self.widths.popitem(last=False)
+        return width
+
+    def metrics(self, font, *options):
+        if font.key in self.font_metrics:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.font_metrics[font.key] = font.raw_metrics()
+        metrics = self.font_metrics[font.key]
+        if len(options) == 1:
+            return metrics[options[0]]
+        return dict(metrics)
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self.widths.clear()
+        self.font_metrics.clear()
+        self.reset_stats()
+
+    def __repr__(self):
+        return "FontMetricsCache(widths={}, hits={}, misses={})".format(
+            len(self.widths), self.hits, self.misses)
+
+FONT_METRICS = FontMetricsCache()
+
+# Font backends. A backend's create_font(size, weight, slant) returns a
+# font with measure(text) and metrics(*options) like tkinter.font.Font;
+# both go through FONT_METRICS, which calls the font's raw_measure(text)
+# and raw_metrics() on a miss.
+class TkFont(tkinter.font.Font):
+    def __init__(self, size, weight, slant):
+        super().__init__(size=size, weight=weight, slant=slant)
+        self.key = (size, weight, slant)
+
+    def measure(self, text, displayof=None):
+        return FONT_METRICS.measure(self, text)
+
+    def metrics(self, *options, **kw):
+        return FONT_METRICS.metrics(self, *options)
+
+    def raw_measure(self, text):
+        return tkinter.font.Font.measure(self, text)
+
+    def raw_metrics(self):
+        return tkinter.font.Font.metrics(self)
+
+class TkFontBackend:
+    def create_font(self, size, weight, slant):
+        return TkFont(size, weight, slant)
+
+    def __repr__(self):
+        return "TkFontBackend()"
+
+# Advance widths in thousandths of an em, roughly those of Times Roman
+FIXED_ADVANCES = {}
+for chars, advance in [
+    (" ", 250), ("ijl.,;:'!|`", 278), ("frtI()[]-/\\", 333), ("\"", 408),
+    ("sz*^", 389), ("acegkvxy?", 444), ("bdhnopqu0123456789$#_J", 500),
+    ("FPS", 556), ("ELTZ+<=>~", 564), ("BCR", 667), ("AKVXY", 722),
+    ("DGHNOQU&w", 722), ("m", 778), ("M", 889), ("%", 833), ("W@", 944),
+]:
+    for c in chars:
+        FIXED_ADVANCES[c] = advance
+FIXED_DEFAULT_ADVANCE = 500
+
+# Table-driven metrics that need no display, for headless layout
+class FixedFont:
+    def __init__(self, size, weight, slant, advances=FIXED_ADVANCES):
+        self.key = (size, weight, slant)
+        self.size = size
+        self.weight = weight
+        self.slant = slant
+        self.advances = advances
+        # Tk sizes are in points; lay out at 96 pixels per inch
+        self.em = size * 96 / 72
+
+    def measure(self, text, displayof=None):
+        return FONT_METRICS.measure(self, text)
+
+    def metrics(self, *options, **kw):
+        return FONT_METRICS.metrics(self, *options)
+
+    def raw_measure(self, text):
+        units = sum([self.advances.get(c, FIXED_DEFAULT_ADVANCE) for c in text])
+        if self.weight == "bold":
+            units *= 1.05
+        return round(units * self.em / 1000)
+
+    def raw_metrics(self):
+        ascent = round(self.em * 0.891)
+        descent = round(self.em * 0.216)
+        return {"ascent": ascent, "descent": descent,
+                "linespace": ascent + descent, "fixed": 0}
+
+    def __repr__(self):
+        return "FixedFont(size={}, weight={}, slant={})".format(
+            self.size, self.weight, self.slant)
+
+class FixedFontBackend:
+    def __init__(self, advances=FIXED_ADVANCES):
+        self.advances = advances
+
+    def create_font(self, size, weight, slant):
+        return FixedFont(size, weight, slant, self.advances)
+
+    def __repr__(self):
+        return "FixedFontBackend()"
+
+FONT_BACKEND = TkFontBackend()
+
+def set_font_backend(backend):
+    global FONT_BACKEND
+    FONT_BACKEND = backend
+    FONTS.clear()
+    FONT_METRICS.clear()
+
+# Display commands bucketed into horizontal tiles by the y range they
+# cover, so drawing a viewport only looks at commands near it.
+# query() returns the commands intersecting [top, bottom] in paint order.
+class DisplayListIndex:
+    def __init__(self, display_list, tile_height=TILE_HEIGHT):
+        self.display_list = display_list
+        self.tile_height = tile_height
+        self.tiles = {}
+        for i, cmd in enumerate(display_list):
+            first = int(min(cmd.top, cmd.bottom) // tile_height)
+            last = int(max(cmd.top, cmd.bottom) // tile_height)
+            for tile in range(first, last + 1):
+                self.tiles.setdefault(tile, []).append(i)
+
+    def query(self, top, bottom):
+        found = set()
+        for tile in range(int(top // self.tile_height),
+                          int(bottom // self.tile_height) + 1):
+            found.update(self.tiles.get(tile, ()))
+        cmds = []
+        for i in sorted(found):
+            cmd = self.display_list[i]
+            if cmd.top > bottom: continue
+            if cmd.bottom < top: continue
+            cmds.append(cmd)
+        return cmds
+
+    def __repr__(self):
+        return "DisplayListIndex(commands={}, tiles={})".format(
+            len(self.display_list), len(self.tiles))
+
+# Layout objects bucketed into tiles by y, plus node -> layout object and
+# id -> block maps, so clicks, the caret and #fragment links don't have
+# to walk the whole layout tree.
+class HitTestIndex:
+    def __init__(self, document, tile_height=TILE_HEIGHT):
+        self.tile_height = tile_height
+        self.objects = tree_to_list(document, [])
+        self.tiles = {}
+        self.by_node = {}
+        self.ids = {}
+        for i, obj in enumerate(self.objects):
+            self.by_node.setdefault(obj.node, []).append(obj)
+            if isinstance(obj, BlockLayout) and isinstance(obj.node, Element) \
+                    and "id" in obj.node.attributes:
+                self.ids.setdefault(obj.node.attributes["id"], obj)
+            first = int(obj.y // tile_height)
+            last = int((obj.y + max(obj.height, 0)) // tile_height)
+            for tile in range(first, last + 1):
+                self.tiles.setdefault(tile, []).append(i)
+
+    def hit(self, x, y):
+        # the last object in tree order containing the point, if any
+        for i in reversed(self.tiles.get(int(y // self.tile_height), [])):
+            obj = self.objects[i]
+            if obj.x <= x < obj.x + obj.width \
+                    and obj.y <= y < obj.y + obj.height:
+                return obj
+        return None
+
+    def layout_for(self, node, kind):
+        for obj in self.by_node.get(node, []):
+            if isinstance(obj, kind):
+                return obj
+        return None
+
+    def __repr__(self):
+        return "HitTestIndex(objects={}, tiles={})".format(
+            len(self.objects), len(self.tiles))
+
+# Colors the raster backends know by name; others are drawn gray
+NAMED_COLORS = {
+    "black": (0, 0, 0), "white": (255, 255, 255), "gray": (128, 128, 128),
+    "grey": (128, 128, 128), "lightgray": (211, 211, 211),
+    "silver": (192, 192, 192), "red": (255, 0, 0), "maroon": (128, 0, 0),
+    "orange": (255, 165, 0), "yellow": (255, 255, 0), "green": (0, 128, 0),
+    "lime": (0, 255, 0), "lightgreen": (144, 238, 144), "olive": (128, 128, 0),
+    "blue": (0, 0, 255), "navy": (0, 0, 128), "lightblue": (173, 216, 230),
+    "teal": (0, 128, 128), "aqua": (0, 255, 255), "purple": (128, 0, 128),
+    "fuchsia": (255, 0, 255), "pink": (255, 192, 203), "brown": (165, 42, 42),
+}
+
+def parse_color(color):
+    if color.startswith("#"):
+        digits = color[1:]
+        if len(digits) == 3:
+            digits = "".join(c * 2 for c in digits)
+        try:
+            return tuple(int(digits[i:i+2], 16) for i in (0, 2, 4)) \
+                if len(digits) == 6 else NAMED_COLORS["gray"]
+        except ValueError:
+            return NAMED_COLORS["gray"]
+    return NAMED_COLORS.get(color.lower(), NAMED_COLORS["gray"])
+
+def clip_span(start, end, limit):
+    # round halves up, so a command lands on the same pixels whichever
+    # whole-pixel offset it's drawn at
+    start, end = math.floor(start + 0.5), math.floor(end + 0.5)
+    return max(0, min(start, limit)), max(0, min(end, limit))
+
+# Raster backends. A backend's create_surface(width, height) returns an
+# RGB surface with fill_rect(x1, y1, x2, y2, color), blit(surface, x, y),
+# pixel(x, y) and to_ppm(), all clipped to the surface.
+class PythonSurface:
+    def __init__(self, width, height, color="white"):
+        self.width = width
+        self.height = height
+        background = bytes(parse_color(color)) * width
+        self.rows = [bytearray(background) for _ in range(height)]
+
+    def fill_rect(self, x1, y1, x2, y2, color):
+        x1, x2 = clip_span(x1, x2, self.width)
+        y1, y2 = clip_span(y1, y2, self.height)
+        if x1 >= x2: return
+        run = bytes(parse_color(color)) * (x2 - x1)
+        for row in self.rows[y1:y2]:
+            row[3 * x1:3 * x2] = run
+
+    def blit(self, surface, x, y):
+        x1, x2 = clip_span(x, x + surface.width, self.width)
+        y1, y2 = clip_span(y, y + surface.height, self.height)
+        for dst_y in range(y1, y2):
+            src = surface.rows[dst_y - y]
+            self.rows[dst_y][3 * x1:3 * x2] = src[3 * (x1 - x):3 * (x2 - x)]
+
+    def pixel(self, x, y):
+        return tuple(self.rows[y][3 * x:3 * x + 3])
+
+    def to_ppm(self):
+        return "P6 {} {} 255\n".format(self.width, self.height).encode() + \
+            b"".join(self.rows)
+
+class PythonRasterBackend:
+    def create_surface(self, width, height):
+        return PythonSurface(width, height)
+
+    def __repr__(self):
+        return "PythonRasterBackend()"
+
+class NumpySurface:
+    def __init__(self, width, height, color="white"):
+        self.width = width
+        self.height = height
+        self.pixels = numpy.empty((height, width, 3), numpy.uint8)
+        self.pixels[:] = parse_color(color)
+
+    def fill_rect(self, x1, y1, x2, y2, color):
+        x1, x2 = clip_span(x1, x2, self.width)
+        y1, y2 = clip_span(y1, y2, self.height)
+        if x1 >= x2 or y1 >= y2: return
+        self.pixels[y1:y2, x1:x2] = parse_color(color)
+
+    def blit(self, surface, x, y):
+        x1, x2 = clip_span(x, x + surface.width, self.width)
+        y1, y2 = clip_span(y, y + surface.height, self.height)
+        if x1 >= x2 or y1 >= y2: return
+        self.pixels[y1:y2, x1:x2] = \
+            surface.pixels[y1 - y:y2 - y, x1 - x:x2 - x]
+
+    def pixel(self, x, y):
+        return tuple(int(v) for v in self.pixels[y, x])
+
+    def to_ppm(self):
+        return "P6 {} {} 255\n".format(self.width, self.height).encode() + \
+            self.pixels.tobytes()
+
+class NumpyRasterBackend:
+    def create_surface(self, width, height):
+        return NumpySurface(width, height)
+
+    def __repr__(self):
+        return "NumpyRasterBackend()"
+
+RASTER_BACKEND = NumpyRasterBackend() if numpy else PythonRasterBackend()
+
+def set_raster_backend(backend):
+    global RASTER_BACKEND
+    RASTER_BACKEND = backend
+
+# Draws display lists into surfaces without a display. The page is cut
+# into tile_height-high layers, each rasterized once and kept until its
+# commands change; a frame is the visible layers blitted at the scroll
+# offset, so scrolling a static page redraws no commands. Tk windows don't
+# use this: their canvas keeps items between frames instead (TabView.draw).
+class Compositor:
+    def __init__(self, backend=None, width=WIDTH, height=HEIGHT - CHROME_PX,
+                 tile_height=TILE_HEIGHT, max_layers=MAX_RASTER_LAYERS):
+        self.backend = backend or RASTER_BACKEND
+        self.width = width
+        self.height = height
+        self.tile_height = tile_height
+        self.max_layers = max_layers
+        self.display_list = None
+        self.index = None
+        # tile -> (its commands, as serialized, and their raster)
+        self.layers = collections.OrderedDict()
+        # tiles known to match the current display list
+        self.checked = set()
+        self.rasterized = 0
+        self.reused = 0
+
+    def layer(self, tile):
+        if tile in self.checked:
+            self.layers.move_to_end(tile)
+            self.reused += 1
+            return self.layers[tile][1]
+        # commands are compared by value: a repaint or a frame from a tab
+        # process can bring new command objects equal to the old ones
+        top = tile * self.tile_height
+        cmds = self.index.query(top, top + self.tile_height)
+        commands = serialize_display_list(cmds)
+        self.checked.add(tile)
+        if tile in self.layers and self.layers[tile][0] == commands:
+            self.layers.move_to_end(tile)
+            self.reused += 1
+            return self.layers[tile][1]
+        surface = self.backend.create_surface(self.width, self.tile_height)
+        for cmd in cmds:
+            cmd.raster(surface, top)
+        self.rasterized += 1
+        self.layers[tile] = (commands, surface)
+        self.layers.move_to_end(tile)
+        if len(self.layers) > self.max_layers:
+            evicted, _ = self.layers.popitem(last=False)
+            self.checked.discard(evicted)
+        return surface
+
+    def frame(self, display_list, scroll):
+        if display_list is not self.display_list:
+            self.display_list = display_list
+            self.index = DisplayListIndex(display_list, self.tile_height)
+            self.checked = set()
+        surface = self.backend.create_surface(self.width, self.height)
+        first = int(scroll // self.tile_height)
+        last = int((scroll + self.height - 1) // self.tile_height)
+        for tile in range(first, last + 1):
+            surface.blit(self.layer(tile), 0,
+                         round(tile * self.tile_height - scroll))
+        return surface
+
+    def __repr__(self):
+        return "Compositor(backend={}, layers={}, rasterized={}, reused={})".format(
+            self.backend, len(self.layers), self.rasterized, self.reused)
+
 def get_font(size, weight, slant):
     key = (size, weight, slant)
     if key not in FONTS:
-        font = tkinter.font.Font(size=size, weight=weight, slant=slant)
+        font = FONT_BACKEND.create_font(size, weight, slant)
         FONTS[key] = font
     return FONTS[key]
 
@@ -1102,7 +2616,7 @@ class JSContext:
         child = self.handle_to_node[child_header]
         child.parent = parent
         parent.children.append(child)
-        self.tab.render()
+        self.tab.set_dirty(parent)
     
     def insert_before(self, parent_handle, new_handle, ref_handle):
         parent = self.handle_to_node[parent_handle]
@@ -1111,6 +2625,7 @@ class JSContext:
         ref_index = parent.children.index(ref_node)
         parent.children.insert(ref_index, new_node)
         new_node.parent = parent
+        self.tab.set_dirty(parent)
     
     def query_selector_all(self, selector_text):
         selector = CSSParser(selector_text).selector()
@@ -1154,7 +2669,7 @@ class JSContext:
 
         for child in elt.children:
             child.parent = elt
-        self.tab.render()
+        self.tab.set_dirty(elt)
     
     def XMLHttpRequest_send(self, method, url, body):
         full_url = resolve_url(url, self.tab.url)
@@ -1169,138 +2684,551 @@ def url_origin(url):
     scheme_colon, _, host, _ = url.split("/", 3)
     return scheme_colon + "//" + host
 
-class Tab:
+# Recent timings per phase (e.g. "style", "layout", "paint", "draw",
+# "scroll"), for finding slow frames
+class FrameTimings:
+    def __init__(self, keep=FRAME_SAMPLES):
+        self.keep = keep
+        self.samples = {}
+        # phase -> seconds for the frame being built, and for recent frames
+        self.frame = {}
+        self.frames = collections.deque(maxlen=keep)
+
+    def record(self, phase, seconds):
+        if phase not in self.samples:
+            self.samples[phase] = collections.deque(maxlen=self.keep)
+        self.samples[phase].append(seconds)
+        self.frame[phase] = self.frame.get(phase, 0) + seconds
+
+    def end_frame(self):
+        frame, self.frame = self.frame, {}
+        if frame:
+            self.frames.append(frame)
+        return frame
+
+    def breakdown(self):
+        # phase -> average ms per frame, over recent frames
+        totals = {}
+        for frame in self.frames:
+            for phase, seconds in frame.items():
+                totals[phase] = totals.get(phase, 0) + seconds
+        return {phase: 1000 * total / len(self.frames)
+                for phase, total in totals.items()}
+
+    def summary(self):
+        # phase -> (frames, average ms, worst ms)
+        return {phase: (len(times), 1000 * sum(times) / len(times),
+                        1000 * max(times))
+                for phase, times in self.samples.items() if times}
+
+    def __repr__(self):
+        return "FrameTimings({})".format(", ".join(
+            "{}: avg={:.2f}ms max={:.2f}ms n={}".format(phase, avg, worst, n)
+            for phase, (n, avg, worst) in self.summary().items()))
+
+# What Tab.load builds for a page, kept when navigating away so going
+# back can put it back instead of loading the page again
+PAGE_STATE = ["url", "nodes", "rules", "rule_index", "js", "document",
+              "display_list", "scroll", "secured", "referrer_policy",
+              "allowed_origins", "focus"]
+
+# Recently left pages, keyed by tab id and history position, evicted least
+# recently stored first once their estimated size passes max_bytes
+class BackForwardCache:
+    def __init__(self, max_bytes=MAX_BFCACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def put(self, tab_id, position, state):
+        self.remove(tab_id, position)
+        size = len(tree_to_list(state["nodes"], [])) * PAGE_BYTES_PER_NODE + \
+            len(state["display_list"]) * PAGE_BYTES_PER_COMMAND
+        if size > self.max_bytes: return
+        self.entries[(tab_id, position)] = (state, size)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.bytes -= evicted
+
+    def take(self, tab_id, position, url):
+        entry = self.entries.pop((tab_id, position), None)
+        if entry:
+            self.bytes -= entry[1]
+            if entry[0]["url"] == url:
+                self.hits += 1
+                return entry[0]
+        self.misses += 1
+        return None
+
+    def remove(self, tab_id, position):
+        entry = self.entries.pop((tab_id, position), None)
+        if entry:
+            self.bytes -= entry[1]
+
+    def forget_tab(self, tab_id):
+        # a closed tab's pages can't be gone back to
+        for key in [key for key in self.entries if key[0] == tab_id]:
+            self.remove(*key)
+
+    def __repr__(self):
+        return "BackForwardCache(pages={}, bytes={}, hits={}, misses={})".format(
+            len(self.entries), self.bytes, self.hits, self.misses)
+
+BACK_FORWARD_CACHE = BackForwardCache()
+TAB_IDS = itertools.count()
+
+# Scrolling and retained-mode drawing of a tab's display list, shared by
+# Tab and by TabProcess, which draws frames sent by a tab process
+class TabView:
+    def forget_canvas(self):
+        # canvas item (and the top it was drawn at) for each visible command
+        self.canvas_items = {}
+        self.drawn_offset = None
+
+    def draw(self, canvas):
+        # Canvas items are kept between frames: scrolling moves them all
+        # at once, and only newly exposed commands get new items.
+        start = time.perf_counter()
+        if self.display_index is None:
+            self.display_index = DisplayListIndex(self.display_list)
+        visible = self.display_index.query(
+            self.scroll, self.scroll + HEIGHT - CHROME_PX)
+        offset = self.scroll - CHROME_PX
+        if self.drawn_offset is not None and offset != self.drawn_offset:
+            canvas.move("content", 0, self.drawn_offset - offset)
+        self.drawn_offset = offset
+
+        items = {}
+        new = []
+        for cmd in visible:
+            if cmd in self.canvas_items:
+                item, top = self.canvas_items.pop(cmd)
+                if top != cmd.top:
+                    canvas.move(item, 0, cmd.top - top)
+                items[cmd] = (item, cmd.top)
+            else:
+                new.append(cmd)
+        for item, top in self.canvas_items.values():
+            canvas.delete(item)
+        for cmd in new:
+            items[cmd] = (cmd.execute(offset, canvas), cmd.top)
+        self.canvas_items = items
+
+        # new items start on top; put any that paint before an existing
+        # item back below it
+        if new and len(new) < len(visible):
+            created = set(new)
+            seen_existing = False
+            above = None
+            for cmd in reversed(visible):
+                item, _ = items[cmd]
+                if cmd not in created:
+                    seen_existing = True
+                elif seen_existing:
+                    canvas.tag_lower(item, above)
+                above = item
+
+        canvas.delete("overlay")
+        if (self.page_height() >= HEIGHT):
+            x1 = WIDTH - 8
+            x2 = WIDTH
+            doc_height = self.page_height()
+            screen_height = HEIGHT
+
+            scroll_height = screen_height * screen_height / doc_height
+
+            y1 = self.scroll * screen_height / doc_height
+            y2 = y1 + scroll_height
+            color = "blue"
+
+            scroll_bar = DrawRect(x1, y1, x2, y2, color)
+            scroll_bar.execute(0, canvas, "overlay")
+        
+        caret = self.caret()
+        if caret:
+            x, y, height = caret
+            y = y - self.scroll + CHROME_PX
+            canvas.create_line(x, y, x, y + height, tags="overlay")
+        self.timings.record("draw", time.perf_counter() - start)
+    
+    def scrolldown(self):
+        max_y = self.page_height() - (HEIGHT - CHROME_PX)
+        self.scroll = min(self.scroll + SCROLL_STEP, max_y)
+
+    def scrollup(self):
+        self.scroll -= SCROLL_STEP
+        if self.scroll < 0:
+            self.scroll = 0
+    
+    def scrolling(self, ev):
+        if ev.delta > 0:
+            self.scrollup()
+        else:
+            self.scrolldown()
+
+class Tab(TabView):
     def __init__(self, browser):
-        with open("browser.css") as f:
-            self.default_style_sheet = CSSParser(f.read()).parse()
+        with open("browser.css", "rb") as f:
+            self.default_style_sheet = STYLESHEET_CACHE.parse("browser.css", f.read())
+        self.id = next(TAB_IDS)
         self.history = []
         self.active_tab = None
         self.browser = browser
         self.focus = None
         self.url = None
+        self.secured = False
         self.referrer_policy = None
-    
+        self.document = None
+        self.scroll = 0
+        self.display_list = []
+        self.dirty_nodes = []
+        # set by DOM changes; they're rendered together in the next frame
+        self.needs_render = False
+        self.display_index = None
+        self.hit_index = None
+        self.timings = FrameTimings()
+        self.loading = False
+        self.loading_url = None
+        # called whenever loading has painted a new frame
+        self.on_frame = None
+        # runs a function on the UI thread and waits for it, for a tab
+        # whose loader runs on another thread
+        self.run_on_ui = None
+        self.forget_canvas()
+
+    def close(self):
+        BACK_FORWARD_CACHE.forget_tab(self.id)
+
     def load(self, url, body=None):
+        self.loading = True
+        self.loading_url = url
+        try:
+            self.load_page(url, body)
+        finally:
+            self.loading = False
+    
+    def load_page(self, url, body):
         frag = url
         if "#" in url:
             frag, frag2 = url.split("#", 1)
-        
-        headers, body, secured = request(frag, self.url, body, referrer_policy=self.referrer_policy)
+
+        # keep the page we're leaving in case the user comes back to it
+        if self.document:
+            BACK_FORWARD_CACHE.put(self.id, len(self.history),
+                {name: getattr(self, name) for name in PAGE_STATE})
+
+        # parse the page while it downloads, and start fetching scripts
+        # and stylesheets as soon as their tags show up
+        self.fetcher = concurrent.futures.ThreadPoolExecutor(
+            max_workers=MAX_SUBRESOURCE_FETCHES)
+        self.subresources = {}
+        self.pipeline = []
+        self.headers_read = False
+        self.parser = HTMLParser(
+            on_element=lambda node: self.found_element(node, url))
+        headers, body, secured = request(frag, self.url, body,
+            referrer_policy=self.referrer_policy, stream=self.receive, raw=True)
+        if not self.headers_read:
+            self.read_headers(headers)
+            self.parser.feed(decode_body(headers, body))
+            self.flush_pipeline()
         self.secured = secured
         self.scroll = 0
+        self.focus = None
         self.url = url
         self.history.append(url)
-        self.nodes = HTMLParser(body).parse()
+        self.nodes = self.parser.close()
+        self.document = None
+        self.dirty_nodes = []
         self.rules = self.default_style_sheet.copy()
-
-        if "referrer-policy" in headers:
-            self.referrer_policy = headers["referrer-policy"]
-        else:
-            self.referrer_policy = None
-
-        self.allowed_origins = None
-        if "content-security-policy" in headers:
-            csp = headers["content-security-policy"].split()
-            if len(csp) > 0 and csp[0] == "default-src":
-                self.allowed_origins = csp[1:]
         
-        links = [node.attributes["href"]
-                 for node in tree_to_list(self.nodes, [])
+        links = [node for node in tree_to_list(self.nodes, [])
                  if isinstance(node, Element)
                  and node.tag == "link"
                  and "href" in node.attributes
                  and node.attributes.get("rel") == "stylesheet"]
 
-        scripts = [node.attributes["src"] for node
+        scripts = [node for node
                    in tree_to_list(self.nodes, [])
                    if isinstance(node, Element)
                    and node.tag == "script"
                    and "src" in node.attributes]
+        script_fetches = [(node.attributes["src"], self.fetch_subresource(node, url))
+                          for node in scripts]
+        style_fetches = [(resolve_url(node.attributes["href"], url),
+                          self.fetch_subresource(node, url)) for node in links]
+        self.flush_pipeline()
+        self.fetcher.shutdown(wait=False)
+
+        # paint as soon as the HTML is in, with whichever stylesheets have
+        # already arrived; the rest apply in document order as they come,
+        # repainting each time
+        style_fetches = [(link, fetch) for link, fetch in style_fetches if fetch]
+        while style_fetches and style_fetches[0][1].done():
+            self.apply_stylesheet(*style_fetches.pop(0))
+        self.rule_index = RuleIndex(self.rules)
+        self.render_frame()
+
+        # scripts run in document order
         self.js = JSContext(self)
-        for script in scripts:
-            script_url = resolve_url(script, url)
-            if not self.allowed_request(script_url):
-                print("Blocked script", script, "due to CSP")
-                continue
-            header, body, _ = request(script_url, url, referrer_policy=self.referrer_policy)
+        for script, fetch in script_fetches:
+            if not fetch: continue
+            header, body, _ = fetch.result()
             try:
-                self.js.run(body)
+                self.js.run(decode_body(header, body))
             except dukpy.JSRuntimeError as e:
                 print("Script", script, "crashed", e)
+        if self.needs_render:
+            self.render_frame()
         
-        for link in links:
-            style_url = resolve_url(link, url)
-            if not self.allowed_request(style_url):
-                print("Blocked style", link, "due to CSP")
-                continue
-            try:
-                header, body, _ = request(style_url, url, referrer_policy=self.referrer_policy)
-            except:
-                continue
-            self.rules.extend(CSSParser(body).parse())
+        for link, fetch in style_fetches:
+            if not self.apply_stylesheet(link, fetch): continue
+            self.rule_index = RuleIndex(self.rules)
+            self.document = None
+            self.render_frame()
 
         for node in tree_to_list(self.nodes, []):
             if isinstance(node, Element) and "id" in node.attributes:
                 self.js.run("{} = new Node({})".format(node.attributes["id"], self.js.get_handle(node)))
 
         if "#" in url:
-            node_list = []
-            tree_to_list(self.document, node_list)
-            for node in node_list:
-                if isinstance(node, BlockLayout) and isinstance(node.node, Element) \
-                        and node.node.attributes.get("id") == frag2:
-                    self.scroll = node.y
-                    break
-        self.render()
+            self.scroll_to_id(frag2)
+        SPECULATIVE_LOADER.start(self, self.nodes, url)
     
+    def apply_stylesheet(self, link, fetch):
+        try:
+            header, body, _ = fetch.result()
+        except:
+            return False
+        self.rules.extend(STYLESHEET_CACHE.parse(
+            link, body, response_charset(header)))
+        return True
+
+    def receive(self, headers, chunk):
+        if not self.headers_read:
+            self.read_headers(headers)
+            self.headers_read = True
+        self.parser.feed(chunk)
+        self.flush_pipeline()
+
+    def read_headers(self, headers):
+        if "referrer-policy" in headers:
+            self.referrer_policy = headers["referrer-policy"]
+        else:
+            self.referrer_policy = None
+
+        self.allowed_origins = None
+        if "content-security-policy" in headers:
+            csp = headers["content-security-policy"].split()
+            if len(csp) > 0 and csp[0] == "default-src":
+                self.allowed_origins = csp[1:]
+
+    def found_element(self, node, url):
+        # start looking up hosts the page links to, then fetch the
+        # element's script or stylesheet if it has one
+        href = node.attributes.get("src" if node.tag == "script" else "href")
+        if node.tag in ["a", "link", "script"] and href:
+            link = resolve_url(href, url)
+            if link.startswith(("http://", "https://")):
+                DNS_CACHE.prefetch(split_url(link)[1])
+        self.fetch_subresource(node, url)
+
+    def fetch_subresource(self, node, url):
+        if node in self.subresources:
+            return self.subresources[node]
+        if node.tag == "script" and "src" in node.attributes:
+            src = node.attributes["src"]
+            kind = "script"
+        elif node.tag == "link" and "href" in node.attributes \
+                and node.attributes.get("rel") == "stylesheet":
+            src = node.attributes["href"]
+            kind = "style"
+        else:
+            return None
+        sub_url = resolve_url(src, url)
+        if not self.allowed_request(sub_url):
+            print("Blocked", kind, src, "due to CSP")
+            fetch = None
+        elif sub_url.startswith(("http://", "https://")) \
+                and url_origin(sub_url) == url_origin(url):
+            # same-origin fetches found in one parse step share a
+            # pipelined connection; see flush_pipeline
+            fetch = concurrent.futures.Future()
+            self.pipeline.append((sub_url, fetch))
+        else:
+            fetch = self.fetcher.submit(request, sub_url, url,
+                referrer_policy=self.referrer_policy, raw=True)
+        self.subresources[node] = fetch
+        return fetch
+
+    def flush_pipeline(self):
+        if not self.pipeline: return
+        batch, self.pipeline = self.pipeline, []
+        self.fetcher.submit(self.fetch_batch, batch, self.loading_url)
+
+    def fetch_batch(self, batch, url):
+        # each fetch completes as soon as its response is in
+        try:
+            request_batch([sub_url for sub_url, _ in batch], url,
+                referrer_policy=self.referrer_policy, raw=True,
+                on_result=lambda i, result: batch[i][1].set_result(result))
+        except Exception:
+            pass
+        # if the batch failed, find out which one did by fetching the rest
+        # one at a time
+        for sub_url, fetch in batch:
+            if fetch.done(): continue
+            try:
+                fetch.set_result(request(sub_url, url,
+                    referrer_policy=self.referrer_policy, raw=True))
+            except Exception as e:
+                fetch.set_exception(e)
+
     def allowed_request(self, url):
         return self.allowed_origins == None or \
             url_origin(url) in self.allowed_origins
     
+    def set_dirty(self, node, level=LAYOUT_DIRTY):
+        self.set_needs_render()
+        if node.dirty >= level: return
+        if not node.dirty:
+            self.dirty_nodes.append(node)
+        node.dirty = level
+
+    def set_needs_render(self):
+        self.needs_render = True
+
     def render(self):
-        style(self.nodes, sorted(self.rules, key=cascade_priority))
-        self.document = DocumentLayout(self.nodes)
-        self.document.layout()
-        self.display_list = []
-        self.document.paint(self.display_list)
+        # the new layout and display list are swapped in only when done,
+        # so a page loading on another thread can be drawn meanwhile
+        self.needs_render = False
+        if self.document is None:
+            start = time.perf_counter()
+            style(self.nodes, self.rule_index)
+            self.timings.record("style", time.perf_counter() - start)
+            start = time.perf_counter()
+            document = DocumentLayout(self.nodes)
+            document.layout()
+            self.timings.record("layout", time.perf_counter() - start)
+            self.document = document
+            for node in self.dirty_nodes:
+                node.dirty = 0
+            self.dirty_nodes = []
+        else:
+            self.update_dirty()
+        start = time.perf_counter()
+        display_list = []
+        self.document.paint(display_list)
+        self.timings.record("paint", time.perf_counter() - start)
+        self.display_list = display_list
+        self.display_index = None
+        self.hit_index = None
+
+    def render_frame(self):
+        # Tk fonts may only be used from the UI thread, so a loader on
+        # another thread has its renders done there, waiting meanwhile so
+        # the page holds still
+        if self.run_on_ui:
+            self.run_on_ui(self.render)
+        else:
+            self.render()
+        if self.on_frame: self.on_frame()
+
+    def draw(self, canvas):
+        # changes since the last frame are rendered once, just before it's
+        # drawn; a loading tab's loader renders for itself
+        if self.needs_render and not self.loading:
+            self.render()
+        TabView.draw(self, canvas)
+
+    def page_height(self):
+        return self.document.height if self.document else 0
+
+    def caret(self):
+        # (x, y, height) of the text cursor in the focused input, if any
+        if not self.focus: return None
+        obj = self.layout_index().layout_for(self.focus, InputLayout)
+        text = self.focus.attributes.get("value", "")
+        return obj.x + obj.font.measure(text), obj.y, obj.height
+
+    def layout_index(self):
+        # hit testing needs the current layout, so render now if a change
+        # is waiting for the next frame; a loading tab's loader renders
+        # for itself
+        if self.needs_render and not self.loading:
+            self.render()
+        if self.hit_index is None:
+            self.hit_index = HitTestIndex(self.document)
+        return self.hit_index
+
+    def scroll_to_id(self, id):
+        block = self.layout_index().ids.get(id)
+        if block:
+            self.scroll = block.y
+
+    def update_dirty(self):
+        dirty_nodes, self.dirty_nodes = self.dirty_nodes, []
+        # skip nodes no longer in the page, or under a node that will be
+        # restyled and laid out anyway
+        todo = []
+        for node in dirty_nodes:
+            covered = False
+            ancestor = node
+            while ancestor.parent:
+                ancestor = ancestor.parent
+                if ancestor.dirty == LAYOUT_DIRTY:
+                    covered = True
+            if ancestor is self.nodes and not covered:
+                todo.append((node, node.dirty))
+        for node in dirty_nodes:
+            node.dirty = 0
+
+        relayout = []
+        styling = 0
+        for node, level in todo:
+            block = self.document.containing_block(node)
+            if level == LAYOUT_DIRTY:
+                start = time.perf_counter()
+                style(node, self.rule_index)
+                styling += time.perf_counter() - start
+                if block not in relayout:
+                    relayout.append(block)
+            else:
+                block.painted = None
+        self.timings.record("style", styling)
+
+        start = time.perf_counter()
+        for block in relayout:
+            ancestor = block.parent
+            while ancestor and ancestor not in relayout:
+                ancestor = ancestor.parent
+            if not ancestor:
+                self.document.relayout(block)
+        self.timings.record("layout", time.perf_counter() - start)
     
     def go_back(self):
         if len(self.history) > 1:
             self.history.pop()
-            back = self.history.pop()
-            self.load(back)
-
-    def draw(self, canvas):
-        canvas.delete("all")
-        for cmd in self.display_list:
-            if cmd.top > self.scroll + HEIGHT - CHROME_PX: continue
-            if cmd.bottom < self.scroll: continue
-            cmd.execute(self.scroll - CHROME_PX, canvas)
-        
-        if (self.document.height >= HEIGHT):
-            x1 = WIDTH - 8
-            x2 = WIDTH
-            doc_height = self.document.height
-            screen_height = HEIGHT
-
-            scroll_height = screen_height * screen_height / doc_height
-
-            y1 = self.scroll * screen_height / doc_height
-            y2 = y1 + scroll_height
-            color = "blue"
+            back = self.history[-1]
+            state = BACK_FORWARD_CACHE.take(self.id, len(self.history), back)
+            if state:
+                self.restore(state)
+            else:
+                self.history.pop()
+                self.load(back)
+
+    def restore(self, state):
+        # show a page from the back-forward cache as it was left, scroll
+        # position included
+        for name, value in state.items():
+            setattr(self, name, value)
+        self.dirty_nodes = []
+        self.display_index = None
+        self.hit_index = None
 
-            scroll_bar = DrawRect(x1, y1, x2, y2, color)
-            scroll_bar.execute(0, canvas)
-        
-        if self.focus:
-            obj = [obj for obj in tree_to_list(self.document, [])
-                   if obj.node == self.focus and \
-                        isinstance(obj, InputLayout)][0]
-            text = self.focus.attributes.get("value", "")
-            x = obj.x + obj.font.measure(text)
-            y = obj.y - self.scroll + CHROME_PX
-            canvas.create_line(x, y, x, y + obj.height)
-    
     def submit_form(self, elt):
         if self.js.dispatch_event("submit", elt): return
         inputs = [node for node in tree_to_list(elt, [])
@@ -1328,26 +3256,11 @@ class Tab:
         else:
             self.load(url + "?" + body)
 
-    def scrolldown(self):
-        max_y = self.document.height - (HEIGHT - CHROME_PX)
-        self.scroll = min(self.scroll + SCROLL_STEP, max_y)
-
-    def scrollup(self):
-        self.scroll -= SCROLL_STEP
-        if self.scroll < 0:
-            self.scroll = 0
-    
-    def scrolling(self, ev):
-        if ev.delta > 0:
-            self.scrollup()
-        else:
-            self.scrolldown()
-    
     def keypress(self, char):
         if self.focus:
             if self.js.dispatch_event("keydown", self.focus): return
             self.focus.attributes["value"] += char
-            self.render()
+            self.set_dirty(self.focus, PAINT_DIRTY)
     
     def enter(self):
         if self.focus and self.focus.tag == "input":
@@ -1371,18 +3284,15 @@ class Tab:
             index = input_list.index(self.focus)
             next_index = (index + 1) % len(input_list)
             self.focus = input_list[next_index]
-            self.focus.attributes["value"] = ""
-            self.render()
+            self.focus.set_attribute("value", "")
+            self.set_dirty(self.focus, PAINT_DIRTY)
 
     def click(self, x, y, button=1):
         x, y = x, y + self.scroll
 
-        objs = [obj for obj in tree_to_list(self.document, [])
-                if obj.x <= x < obj.x + obj.width
-                and obj.y <= y < obj.y + obj.height]
-
-        if not objs: return
-        elt = objs[-1].node
+        obj = self.layout_index().hit(x, y)
+        if not obj: return
+        elt = obj.node
 
         while elt:
             if isinstance(elt, Text):
@@ -1393,11 +3303,11 @@ class Tab:
                     if "checked" in elt.attributes:
                         del elt.attributes["checked"]
                     else:
-                        elt.attributes["checked"] = ""
+                        elt.set_attribute("checked", "")
                 else:
                     self.focus = elt
-                    elt.attributes["value"] = ""
-                return self.render()
+                    elt.set_attribute("value", "")
+                return self.set_dirty(elt, PAINT_DIRTY)
             elif elt.tag == "button":
                 if self.js.dispatch_event("click", elt): return
                 while elt:
@@ -1407,13 +3317,7 @@ class Tab:
             elif elt.tag == "a" and "href" in elt.attributes:
                 if self.js.dispatch_event("click", elt): return
                 if elt.attributes["href"][0] == "#":
-                    node_list = []
-                    tree_to_list(self.document, node_list)
-                    for node in node_list:
-                        if isinstance(node, BlockLayout) and isinstance(node.node, Element) \
-                                and node.node.attributes.get("id") == elt.attributes["href"][1:]:
-                            self.scroll = node.y
-                            break
+                    self.scroll_to_id(elt.attributes["href"][1:])
                     
                     frag = self.url
                     if "#" in self.url:
@@ -1431,6 +3335,277 @@ class Tab:
     def __repr__(self) -> str:
         return "Tab(history={})".format(self.history)
 
+# Display lists go between processes as plain tuples; fonts are rebuilt
+# from their (size, weight, slant) key on the other side
+def serialize_command(cmd):
+    if isinstance(cmd, DrawText):
+        return ("text", cmd.left, cmd.top, cmd.text, cmd.font.key, cmd.color)
+    else:
+        return ("rect", cmd.left, cmd.top, cmd.right, cmd.bottom, cmd.color)
+
+def serialize_display_list(display_list):
+    return [serialize_command(cmd) for cmd in display_list]
+
+def deserialize_command(data):
+    if data[0] == "text":
+        _, x, y, text, font, color = data
+        return DrawText(x, y, text, get_font(*font), color)
+    else:
+        return DrawRect(*data[1:])
+
+def shift_command(data, dy):
+    data = list(data)
+    data[2] += dy
+    if data[0] == "rect":
+        data[4] += dy
+    return tuple(data)
+
+# Most commands outlive a frame (incremental paint keeps the ones for
+# unchanged blocks), so a frame carries the ids of its commands plus the
+# fields of those that are new or changed. The browser side keeps its
+# command objects for the rest, so the retained canvas keeps their items.
+class DisplayListSender:
+    def __init__(self):
+        # command -> (its id, the fields last sent for it)
+        self.sent = {}
+        self.next_id = 0
+
+    def diff(self, display_list):
+        sent = {}
+        ids = []
+        changed = {}
+        for cmd in display_list:
+            data = serialize_command(cmd)
+            if cmd in self.sent:
+                cmd_id, old = self.sent[cmd]
+                if old != data:
+                    changed[cmd_id] = data
+            else:
+                cmd_id = self.next_id
+                self.next_id += 1
+                changed[cmd_id] = data
+            sent[cmd] = (cmd_id, data)
+            ids.append(cmd_id)
+        self.sent = sent
+        return ids, changed
+
+class DisplayListReceiver:
+    def __init__(self):
+        # id -> (command, its fields)
+        self.commands = {}
+
+    def apply(self, ids, changed):
+        for cmd_id, data in changed.items():
+            old = self.commands.get(cmd_id)
+            dy = old and data[2] - old[1][2]
+            if old and shift_command(old[1], dy) == data:
+                # a command moved by relayout moves its canvas item too
+                cmd = old[0]
+                cmd.top += dy
+                cmd.bottom += dy
+            else:
+                cmd = deserialize_command(data)
+            self.commands[cmd_id] = (cmd, data)
+        self.commands = {cmd_id: self.commands[cmd_id] for cmd_id in ids}
+        return [self.commands[cmd_id][0] for cmd_id in ids]
+
+# What a Tab in a tab process sees as its browser: opening a new tab is
+# passed on to the real one
+class TabHost:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def load(self, url, activate=True):
+        self.conn.send(("open", url))
+
+# The tab process: runs a Tab, applying the input events the browser
+# forwards and sending back a frame after each one. Bookmarks and cookies
+# live in the browser process and are kept in sync through "shared"
+# messages.
+def run_tab_process(conn, fixed_fonts, cache_dir):
+    set_http_cache_dir(cache_dir)
+    if fixed_fonts:
+        set_font_backend(FixedFontBackend())
+    else:
+        # Tk fonts need a Tk root, though nothing is shown
+        tkinter.Tk().withdraw()
+    tab = Tab(TabHost(conn))
+    sent_list = None
+    sender = DisplayListSender()
+    sent_scroll = 0
+    sent_cookies = dict(COOKIE_JAR)
+
+    def send_frame():
+        nonlocal sent_list, sent_scroll
+        frame = {
+            "url": tab.url,
+            "secured": tab.secured,
+            "loading": tab.loading,
+            "loading_url": tab.loading_url,
+            "scroll": tab.scroll if tab.scroll != sent_scroll else None,
+            "height": tab.page_height(),
+            "caret": tab.caret(),
+            "display_list": None,
+            "timings": tab.timings.end_frame(),
+        }
+        sent_scroll = tab.scroll
+        if tab.display_list is not sent_list:
+            sent_list = tab.display_list
+            frame["display_list"] = sender.diff(sent_list)
+        conn.send(("frame", frame))
+    tab.on_frame = send_frame
+
+    # input handled since the last frame was sent
+    frame_pending = False
+    def flush_frame():
+        nonlocal frame_pending
+        if not frame_pending: return
+        frame_pending = False
+        try:
+            if tab.needs_render:
+                tab.render()
+        except Exception:
+            traceback.print_exc()
+        # send a frame even if rendering failed, so the browser hears
+        # when a failed load is over
+        try:
+            send_frame()
+        except Exception:
+            traceback.print_exc()
+
+    while True:
+        name, args, scroll = conn.recv()
+        if name == "close" or name == "shared":
+            # only input joins a pending frame
+            flush_frame()
+        if name == "close":
+            tab.close()
+            break
+        if name == "shared":
+            bookmarks, cookies = args
+            BOOKMARKS[:] = bookmarks
+            COOKIE_JAR.clear()
+            COOKIE_JAR.update(cookies)
+            sent_cookies = dict(COOKIE_JAR)
+            continue
+        # the browser's scroll only wins if the user scrolled since the
+        # last frame; a change the tab made may not have been sent yet
+        if scroll != sent_scroll:
+            tab.scroll = sent_scroll = scroll
+        # a page that throws shouldn't take the process down with it
+        try:
+            getattr(tab, name)(*args)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            frame_pending = True
+            if COOKIE_JAR != sent_cookies:
+                sent_cookies = dict(COOKIE_JAR)
+                conn.send(("cookies", sent_cookies))
+        # input that's already waiting goes into the same frame
+        if not conn.poll():
+            flush_frame()
+    conn.close()
+
+# The browser process's side of a tab process: forwards input events to
+# it and draws the frames it sends back, so a slow page only holds up its
+# own process
+class TabProcess(TabView):
+    def __init__(self, browser):
+        self.browser = browser
+        self.url = None
+        self.secured = False
+        self.loading = False
+        self.loading_url = None
+        self.scroll = 0
+        self.height = 0
+        self.caret_position = None
+        self.display_list = []
+        self.display_index = None
+        self.commands = DisplayListReceiver()
+        self.timings = FrameTimings()
+        self.forget_canvas()
+        context = multiprocessing.get_context("spawn")
+        self.conn, child = context.Pipe()
+        self.process = context.Process(target=run_tab_process,
+            args=(child, isinstance(FONT_BACKEND, FixedFontBackend),
+                  HTTP_CACHE_DIR),
+            daemon=True)
+        self.process.start()
+        child.close()
+        self.share(BOOKMARKS, COOKIE_JAR)
+
+    def send(self, name, *args):
+        if self.process.is_alive():
+            self.conn.send((name, args, self.scroll))
+
+    def share(self, bookmarks, cookies):
+        self.send("shared", list(bookmarks), dict(cookies))
+
+    def load(self, url, body=None):
+        self.loading = True
+        self.loading_url = url
+        self.send("load", url, body)
+
+    def click(self, x, y, button=1):
+        self.send("click", x, y, button)
+
+    def keypress(self, char):
+        self.send("keypress", char)
+
+    def enter(self):
+        self.send("enter")
+
+    def tab(self):
+        self.send("tab")
+
+    def go_back(self):
+        self.send("go_back")
+
+    def close(self):
+        self.send("close")
+
+    def receive(self):
+        # handle everything the tab process has sent; True if there's a
+        # new frame to draw
+        new_frame = False
+        while self.conn.poll():
+            try:
+                message = self.conn.recv()
+            except EOFError:
+                break
+            if message[0] == "open":
+                self.browser.load(message[1], activate=False)
+            elif message[0] == "cookies":
+                self.browser.share_cookies(message[1], self)
+            else:
+                frame = message[1]
+                self.url = frame["url"]
+                self.secured = frame["secured"]
+                self.loading = frame["loading"]
+                self.loading_url = frame["loading_url"]
+                self.height = frame["height"]
+                self.caret_position = frame["caret"]
+                for phase, seconds in frame["timings"].items():
+                    self.timings.record(phase, seconds)
+                if frame["scroll"] is not None:
+                    self.scroll = frame["scroll"]
+                if frame["display_list"] is not None:
+                    self.display_list = self.commands.apply(
+                        *frame["display_list"])
+                    self.display_index = None
+                new_frame = True
+        return new_frame
+
+    def page_height(self):
+        return self.height
+
+    def caret(self):
+        return self.caret_position
+
+    def __repr__(self):
+        return "TabProcess(pid={}, url={})".format(self.process.pid, self.url)
+
 class Browser:
     def __init__(self):
         self.window = tkinter.Tk()
@@ -1441,6 +3616,10 @@ class Browser:
             bg="white",
         )
         self.canvas.pack()
+        if TAB_PROCESSES and not HTTP_CACHE_DIR:
+            # where tab processes share the HTTP responses they fetch
+            set_http_cache_dir(tempfile.mkdtemp(prefix="browser-cache-"))
+            atexit.register(shutil.rmtree, HTTP_CACHE_DIR, True)
 
         self.scroll = 0
         self.window.bind("<Down>", self.handle_down)
@@ -1456,42 +3635,133 @@ class Browser:
         self.active_tab = None
         self.focus = None
         self.address_bar = ""
+        self.drawn_tab = None
+        self.chrome_state = None
+        # work handed back to the Tk thread by in-process tabs' loaders
+        self.events = queue.Queue()
+        self.window.after(FRAME_MS, self.poll)
     
     def load(self, url, activate=True):
-        new_tab = Tab(self)
-        new_tab.load(url)
+        if TAB_PROCESSES:
+            new_tab = TabProcess(self)
+        else:
+            new_tab = Tab(self)
+            new_tab.on_frame = lambda: self.events.put(new_tab)
+            new_tab.run_on_ui = self.run_on_ui
         if activate:
             self.active_tab = len(self.tabs)
         self.tabs.append(new_tab)
+        self.start_load(new_tab, url)
         self.draw()
+
+    def start_load(self, tab, url):
+        # a tab process loads without holding up this one; an in-process
+        # tab loads on a thread, and its frames are drawn by poll
+        if isinstance(tab, TabProcess):
+            return tab.load(url)
+        tab.loading = True
+        tab.loading_url = url
+        def run():
+            try:
+                tab.load(url)
+            except Exception:
+                traceback.print_exc()
+            self.events.put(tab)
+        threading.Thread(target=run, daemon=True).start()
+
+    def run_on_ui(self, fn):
+        # called from a loader thread: poll runs fn on the Tk thread
+        if threading.current_thread() is threading.main_thread():
+            return fn()
+        done = threading.Event()
+        errors = []
+        def run():
+            try:
+                fn()
+            except Exception as e:
+                errors.append(e)
+            finally:
+                done.set()
+        self.events.put(run)
+        done.wait()
+        if errors: raise errors[0]
+
+    def busy(self):
+        # an in-process tab can't take input while its loader runs
+        tab = self.tabs[self.active_tab]
+        return tab.loading and not isinstance(tab, TabProcess)
     
+    def poll(self):
+        # one animation frame: however many changes tabs made since the
+        # last one, the active tab is rendered and drawn at most once
+        changed = []
+        while not self.events.empty():
+            event = self.events.get()
+            if isinstance(event, Tab):
+                changed.append(event)
+            else:
+                event()
+        for tab in list(self.tabs):
+            if isinstance(tab, TabProcess) and tab.receive():
+                changed.append(tab)
+            elif isinstance(tab, Tab) and tab.needs_render and not tab.loading:
+                changed.append(tab)
+        if self.tabs and self.tabs[self.active_tab] in changed:
+            self.draw()
+        self.window.after(FRAME_MS, self.poll)
+
+    def share_cookies(self, cookies, source):
+        COOKIE_JAR.update(cookies)
+        for tab in self.tabs:
+            if tab is not source:
+                tab.share(BOOKMARKS, COOKIE_JAR)
+
     def draw(self):
-        self.canvas.delete("all")
-        self.tabs[self.active_tab].draw(self.canvas)
+        tab = self.tabs[self.active_tab]
+        if tab is not self.drawn_tab:
+            # the canvas holds another tab's items, so start over
+            self.canvas.delete("all")
+            tab.forget_canvas()
+            self.drawn_tab = tab
+            self.chrome_state = None
+        tab.draw(self.canvas)
+        self.draw_chrome()
+        tab.timings.end_frame()
+
+    def draw_chrome(self):
+        tab = self.tabs[self.active_tab]
+        state = (len(self.tabs), self.active_tab, tab.url, tab.secured,
+                 tab.loading, tab.loading_url, tab.url in BOOKMARKS,
+                 self.focus, self.address_bar)
+        if state == self.chrome_state:
+            self.canvas.tag_raise("chrome")
+            return
+        self.chrome_state = state
+        self.canvas.delete("chrome")
         self.canvas.create_rectangle(0, 0, WIDTH, CHROME_PX,
-            fill="white", outline="black")
+            fill="white", outline="black", tags="chrome")
         tabfont = get_font(20, "normal", "roman")
         for i, tab in enumerate(self.tabs):
             name = "Tab {}".format(i)
             x1, x2 = 40 + 80 * i, 120 + 80 * i
-            self.canvas.create_line(x1, 0, x1, 40, fill="black")
-            self.canvas.create_line(x2, 0, x2, 40, fill="black")
+            self.canvas.create_line(x1, 0, x1, 40, fill="black", tags="chrome")
+            self.canvas.create_line(x2, 0, x2, 40, fill="black", tags="chrome")
             self.canvas.create_text(x1 + 10, 10, anchor="nw", text=name,
-                font=tabfont, fill="black")
+                font=tabfont, fill="black", tags="chrome")
             if i == self.active_tab:
-                self.canvas.create_line(0, 40, x1, 40, fill="black")
-                self.canvas.create_line(x2, 40, WIDTH, 40, fill="black")
+                self.canvas.create_line(0, 40, x1, 40, fill="black", tags="chrome")
+                self.canvas.create_line(x2, 40, WIDTH, 40, fill="black", tags="chrome")
         
         buttonfont = get_font(30, "normal", "roman")
         self.canvas.create_rectangle(10, 10, 30, 30,
-            outline="black", width=1)
+            outline="black", width=1, tags="chrome")
         self.canvas.create_text(11, 0, anchor="nw", text="+",
-            font=buttonfont, fill="black")
+            font=buttonfont, fill="black", tags="chrome")
         
         self.canvas.create_rectangle(10, 50, 35, 90,
-            outline="black", width=1)
+            outline="black", width=1, tags="chrome")
         self.canvas.create_polygon(
-            15, 70, 30, 55, 30, 85, fill='black')
+            15, 70, 30, 55, 30, 85, fill='black', tags="chrome")
         
         
         if self.tabs[self.active_tab].url in BOOKMARKS:
@@ -1499,16 +3769,20 @@ class Browser:
         else:
             color = "white"
         self.canvas.create_rectangle(WIDTH - 35, 50, WIDTH - 10, 90,
-            outline="black", fill=color, width=1)
+            outline="black", fill=color, width=1, tags="chrome")
 
         self.canvas.create_rectangle(40, 50, WIDTH - 40, 90,
-            outline="black", width=1)
+            outline="black", width=1, tags="chrome")
         if self.focus == "address bar":
             self.canvas.create_text(
                 55, 55, anchor='nw', text=self.address_bar,
-                font=buttonfont, fill="black")
+                font=buttonfont, fill="black", tags="chrome")
             w = buttonfont.measure(self.address_bar)
-            self.canvas.create_line(55 + w, 55, 55 + w, 85, fill="black")
+            self.canvas.create_line(55 + w, 55, 55 + w, 85, fill="black", tags="chrome")
+        elif self.tabs[self.active_tab].loading:
+            address_bar = "\N{HOURGLASS} " + self.tabs[self.active_tab].loading_url
+            self.canvas.create_text(55, 55, anchor='nw', text=address_bar,
+                font=buttonfont, fill="gray", tags="chrome")
         else:
             url = self.tabs[self.active_tab].url
             if self.tabs[self.active_tab].secured:
@@ -1516,7 +3790,7 @@ class Browser:
             else:
                 address_bar = url
             self.canvas.create_text(55, 55, anchor='nw', text=address_bar,
-                font=buttonfont, fill="black")
+                font=buttonfont, fill="black", tags="chrome")
         
     def keypress(self, char):
         if self.focus:
@@ -1524,16 +3798,20 @@ class Browser:
             self.render()
 
     def handle_down(self, e):
-        self.tabs[self.active_tab].scrolldown()
-        self.draw()
+        self.scroll_frame(self.tabs[self.active_tab].scrolldown)
     
     def handle_up(self, e):
-        self.tabs[self.active_tab].scrollup()
-        self.draw()
+        self.scroll_frame(self.tabs[self.active_tab].scrollup)
     
     def handle_scroll(self, e):
-        self.tabs[self.active_tab].scrolling(e)
+        self.scroll_frame(lambda: self.tabs[self.active_tab].scrolling(e))
+
+    def scroll_frame(self, scroll):
+        start = time.perf_counter()
+        scroll()
         self.draw()
+        self.tabs[self.active_tab].timings.record(
+            "scroll", time.perf_counter() - start)
     
     def handle_key(self, e):
         if len(e.char) == 0: return
@@ -1542,16 +3820,16 @@ class Browser:
         if self.focus == "address bar":
             self.address_bar += e.char
             self.draw()
-        elif self.focus == "content":
+        elif self.focus == "content" and not self.busy():
             self.tabs[self.active_tab].keypress(e.char)
-            self.draw()
         
     def handle_enter(self, e):
         if self.focus == "address bar":
-            self.tabs[self.active_tab].load(self.address_bar)
+            if self.busy(): return
+            self.start_load(self.tabs[self.active_tab], self.address_bar)
             self.focus = None
             self.draw()
-        elif self.focus == "content":
+        elif self.focus == "content" and not self.busy():
             self.tabs[self.active_tab].enter()
 
     def handle_click(self, e):
@@ -1562,7 +3840,8 @@ class Browser:
             elif 10 <= e.x < 30 and 10 <= e.y < 30:
                 self.load("https://browser.engineering/")
             elif 10 <= e.x < 35 and 50 <= e.y < 90:
-                self.tabs[self.active_tab].go_back()
+                if not self.busy():
+                    self.tabs[self.active_tab].go_back()
             elif 50 <= e.x < WIDTH - 40 and 50 <= e.y < 90:
                 self.focus = "address bar"
                 self.address_bar = ""
@@ -1572,8 +3851,11 @@ class Browser:
                     BOOKMARKS.append(url)
                 else:
                     BOOKMARKS.remove(url)
+                if TAB_PROCESSES:
+                    for tab in self.tabs:
+                        tab.share(BOOKMARKS, COOKIE_JAR)
             self.draw()
-        else:
+        elif not self.busy():
             self.focus = "content"
             self.tabs[self.active_tab].click(e.x, e.y - CHROME_PX)
     
@@ -1583,11 +3865,11 @@ class Browser:
         self.draw()
     
     def handle_tab(self, e):
-        if self.focus == "content":
+        if self.focus == "content" and not self.busy():
             self.tabs[self.active_tab].tab()
 
     def handle_middle_click(self, e):
-        if e.y >= CHROME_PX:
+        if e.y >= CHROME_PX and not self.busy():
             self.tabs[self.active_tab].click(e.x, e.y - CHROME_PX, button=2)
 
 def print_tree(node, indent=0):
@@ -1597,5 +3879,21 @@ def print_tree(node, indent=0):
 
 if __name__ == "__main__":
     import sys
-    Browser().load(sys.argv[1])
-    tkinter.mainloop()
\ No newline at end of file
+    if sys.argv[1] == "--headless":
+        # lay out and paint without a display, printing the display list
+        set_font_backend(FixedFontBackend())
+        tab = Tab(None)
+        tab.load(sys.argv[2])
+        for cmd in tab.display_list:
+            print(cmd)
+    elif sys.argv[1] == "--screenshot":
+        # composite the first screenful of a page into a PPM image
+        set_font_backend(FixedFontBackend())
+        tab = Tab(None)
+        tab.load(sys.argv[2])
+        frame = Compositor().frame(tab.display_list, tab.scroll)
+        with open(sys.argv[3], "wb") as f:
+            f.write(frame.to_ppm())
+    else:
+        Browser().load(sys.argv[1])
+        tkinter.mainloop()
\ No newline at end of file
@@ -2,6 +2,7 @@ import socket
 import urllib.parse
 import random
 import html
+import threading
 
 ENTRIES = ["Pavel was here"]
 SESSIONS = {}
@@ -16,7 +17,16 @@ LOGINS = {
 
 def handle_connection(conx):
     req = conx.makefile("b")
-    reqline = req.readline().decode('utf8')
+    # HTTP/1.1 clients can keep the connection open and send (or
+    # pipeline) more requests; answer them in order until they're done
+    keep_alive = True
+    while keep_alive:
+        reqline = req.readline().decode('utf8')
+        if not reqline: break
+        keep_alive = handle_request(conx, req, reqline)
+    conx.close()
+
+def handle_request(conx, req, reqline):
     method, url, version = reqline.split(" ", 2)
     assert method in ["GET", "POST"]
     headers = {}
@@ -35,22 +45,26 @@ def handle_connection(conx):
         token = headers['cookie'][len('token='):]
     else:
         token = str(random.random())[2:]
-    if 'cookie' not in headers:
-        template = "Set-Cookie: token={}; SameSite=Lax\r\n"
-        response += template.format(token)
     
     session = SESSIONS.setdefault(token, {})
     status, body = do_request(session, method, url, headers, body)
-    response = "HTTP/1.0 {}\r\n".format(status)
+    keep_alive = version.strip() == "HTTP/1.1" and \
+        headers.get("connection", "").lower() != "close"
+    response = "{} {}\r\n".format(
+        "HTTP/1.1" if keep_alive else "HTTP/1.0", status)
+    if 'cookie' not in headers:
+        template = "Set-Cookie: token={}; SameSite=Lax\r\n"
+        response += template.format(token)
     response += "Content-Length: {}\r\n".format(
         len(body.encode("utf8")))
     csp = "default-src http://localhost:8000"
     response += "Content-Security-Policy: {}\r\n".format(csp)
     response += "\r\n" + body
-    conx.send(response.encode('utf8'))
-    conx.close()
+    conx.sendall(response.encode('utf8'))
+    return keep_alive
 
 def show_comments(session):
+    out = "<!doctype html>"
     if "user" in session:
         nonce = str(random.random())[2:]
         session["nonce"] = nonce
@@ -147,7 +161,9 @@ if __name__ == "__main__":
     s.bind(("", 8000))
     s.listen()
 
-    # Accept the connection
+    # Accept connections, each on its own thread since a keep-alive
+    # connection can stay open between requests
     while True:
         conx, addr = s.accept()
-        handle_connection(conx)
+        threading.Thread(target=handle_connection, args=(conx,),
+                         daemon=True).start()